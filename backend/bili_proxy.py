@@ -75,7 +75,7 @@ class bili_proxy_handler(HttpResponseMixin, FcgiHandler):
 				if method == "POST":
 					content_type = self.environ.get("CONTENT_TYPE", "")
 					data = self["stdin"].read()
-					coroutine = network.request(self.server.sess, method, url, headers = {'Content-Type': content_type}, data = data)
+					coroutine = network.request(self.server.sess, method, url, risk_retry = 0, headers = {'Content-Type': content_type}, data = data)
 
 				else:
 					url_split = url.partition('?')
@@ -83,7 +83,7 @@ class bili_proxy_handler(HttpResponseMixin, FcgiHandler):
 					for key in params.keys():
 						params[key] = params[key][0]
 
-					coroutine = network.request(self.server.sess, method, url_split[0], wbi_sign = wbi_sign, params = params)
+					coroutine = network.request(self.server.sess, method, url_split[0], wbi_sign = wbi_sign, risk_retry = 0, params = params)
 
 				resp = self.server.event_loop.run_until_complete(coroutine)
 
@@ -5,7 +5,6 @@ import sys
 sys.path[0] = os.getcwd()
 
 import re
-import httpx
 import asyncio
 import logging
 import argparse
@@ -18,6 +17,7 @@ from simple_fastcgi import AsyncFcgiServer, AsyncHttpResponseMixin, AsyncFcgiHan
 # constants
 
 import constants
+import network
 
 # static objects
 
@@ -34,7 +34,7 @@ class ImageCacheServer(AsyncFcgiServer):
 		self.cache_size = cache_size
 		self.used_size = 0
 		self.cache_table = OrderedDict()
-		self.sess = httpx.AsyncClient(headers = constants.USER_AGENT, timeout = timeout, follow_redirects = True)
+		self.sess = network.session(credential = {}, timeout = timeout)
 		if cache_size:
 			self.scan_cache()
 
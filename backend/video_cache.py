@@ -30,11 +30,12 @@ def exec_download(video_root, bvid, pipe, arg_list, extra_args):
 	import core
 	import runtime
 	import network
+	import ratelimit
 	import video
 
 	async def download_main(args):
 		try:
-			stall = runtime.Stall()
+			stall = runtime.Stall(controller = ratelimit.api_backoff)
 			async with network.session() as sess:
 				await video.download(sess, bvid, video_root, args.mode, stall = stall, prefer = args.prefer, reject = args.reject, **extra_args)
 		except Exception as e:
@@ -246,8 +247,8 @@ class BVPlayServer(FcgiServer):
 			return
 		try:
 			logger.info("updating db %s", bvid)
-			if self.database.update_video(bvid):
-				self.database.update_video_size(bvid)
+			# info and part sizes from one scan of the directory
+			self.database.update_videos([bvid])
 		except Exception:
 			logger.exception("failed in updating database for %s", bvid)
 
@@ -51,8 +51,8 @@ class QueryHandler(HttpResponseMixin, FcgiHandler):
 			except (TypeError, ValueError, KeyError, IndexError):
 				return self.send_response(400)
 			try:
-				result, count = db.query(rules)
-				return self.send_response(200, json = {"count": count, "data": result})
+				result, count, next_cursor = db.query(rules)
+				return self.send_response(200, json = {"count": count, "data": result, "next": next_cursor})
 			except Exception:
 				return self.send_response(400)
 
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+
+import os
+import time
+import json
+import hashlib
+import logging
+
+import core
+
+# constants
+
+CHECKSUM_ALGORITHM = "blake2b"
+HASH_BLOCK_SIZE = 0x400000
+
+# static objects
+
+logger = logging.getLogger("bili_arch.checksum")
+
+# helper functions
+
+def new_digest():
+	return hashlib.new(CHECKSUM_ALGORITHM)
+
+
+# hash [offset, offset + limit) of fd with large sequential reads,
+# optionally limited to rate bytes per second
+def update_digest(fd, digest, *, offset = 0, limit = None, rate = None, drop_cache = False):
+	end = os.fstat(fd).st_size
+	if limit is not None:
+		end = min(end, offset + limit)
+
+	buffer = memoryview(bytearray(HASH_BLOCK_SIZE))
+	os.posix_fadvise(fd, offset, end - offset, os.POSIX_FADV_SEQUENTIAL)
+	start_time = time.monotonic()
+	pos = offset
+	while pos < end:
+		size = os.preadv(fd, [buffer[:min(HASH_BLOCK_SIZE, end - pos)]], pos)
+		if not size:
+			raise RuntimeError("unexpected EOF at %d" % pos)
+		digest.update(buffer[:size])
+		if drop_cache:
+			os.posix_fadvise(fd, pos, size, os.POSIX_FADV_DONTNEED)
+		pos += size
+
+		if rate:
+			delay = (pos - offset) / rate - (time.monotonic() - start_time)
+			if delay > 0:
+				time.sleep(delay)
+
+	return pos - offset
+
+
+def hash_file(path, *, rate = None):
+	logger.debug("hashing %s", path)
+	fd = os.open(path, os.O_RDONLY)
+	try:
+		digest = new_digest()
+		size = update_digest(fd, digest, rate = rate, drop_cache = True)
+		return size, digest.hexdigest()
+	finally:
+		os.close(fd)
+
+# methods
+
+# per-part manifest, {name: {"size": size, CHECKSUM_ALGORITHM: hex digest}}
+def load_manifest(path):
+	try:
+		with open(os.path.join(path, core.default_names.checksum), "r") as f:
+			return json.load(f)
+	except FileNotFoundError:
+		return {}
+
+
+def update_manifest(path, name, size, digest):
+	manifest_name = os.path.join(path, core.default_names.checksum)
+	try:
+		manifest = load_manifest(path)
+	except Exception as e:
+		logger.warning("bad checksum manifest %s: %s", manifest_name, str(e))
+		manifest = {}
+
+	manifest[name] = {
+		"size": size,
+		CHECKSUM_ALGORITHM: digest,
+	}
+	logger.debug("%s %s %s", name, CHECKSUM_ALGORITHM, digest)
+	with core.staged_file(manifest_name, "w") as f:
+		json.dump(manifest, f, indent = '\t', sort_keys = True)
@@ -14,7 +14,9 @@ UNIT_TABLE = {
 
 DEFAULT_NAME_MAP = {
 	"danmaku": "danmaku.xml",
+	"checksum": "checksum.json",
 	"tmp_ext": ".tmp",
+	"resume_ext": ".resume",
 	"novideo": ".novideo",
 	"noaudio": ".noaudio",
 	"hls_index": "index.m3u8",
@@ -59,7 +59,7 @@ class staged_file:
 		self.tmp_name = None
 		self.rot_mode = bool(rotate)
 		open_mode = mode
-		if 'w' in mode:
+		if 'w' in mode or 'a' in mode:
 			self.tmp_name = filename + default_names.tmp_ext
 			logger.debug("using tmp file %s", self.tmp_name)
 			touch(self.tmp_name)
@@ -67,13 +67,16 @@ class staged_file:
 
 		self.f = locked_file(self.tmp_name or self.filename, mode = open_mode, **kwargs)
 		self.closed = False
-		if 'w' in mode:
-			try:
+		try:
+			if 'w' in mode:
 				self.f.truncate(0)
 				self.f.seek(0)
-			except:
-				self.f.close()
-				raise
+			elif 'a' in mode:
+				# continue with the existing tmp file
+				self.f.seek(0, os.SEEK_END)
+		except:
+			self.f.close()
+			raise
 
 	def __enter__(self):
 		return self.f
@@ -125,6 +128,28 @@ class staged_file:
 			src_fd.close()
 
 
+# one os.scandir pass over path and its sub directories, DirEntry caches
+# the stat result so each file is stat'ed at most once
+class dir_snapshot:
+	def __init__(self, path, /, depth = 1):
+		self.path = path
+		self.files = {}
+		self.dirs = {}
+		with os.scandir(path) as it:
+			for entry in it:
+				if entry.is_dir(follow_symlinks = False):
+					if depth > 0:
+						self.dirs[entry.name] = dir_snapshot(entry.path, depth = depth - 1)
+				elif entry.is_file(follow_symlinks = False):
+					self.files[entry.name] = entry
+
+	def stat(self, name):
+		return self.files[name].stat(follow_symlinks = False)
+
+	def size(self):
+		return sum(self.stat(name).st_size for name in self.files)
+
+
 class locked_path(os.PathLike):
 	def __init__(self, *path_list, shared = False):
 		self.path = os.path.join(*path_list)
@@ -2,37 +2,19 @@
 
 # This daemon utilizes multiple tricks in CPython and Linux to work. Below are the details.
 #
-# 1. Waiting for flock(2) with timeout (see timed_thread_pool.py)
+# 1. Waiting for flock(2) without blocking threads
 # The video.py would place flock(2) on the BV directory when working, and release when done.
-# We depends on this behavior to detect when video.py has done by tryng to also place a flock(2) on it.
-# The syscall would block, until video.py release the lock, and the syscall returns with the lock held.
-# However to prevent possible deadlock, the waiting should have a timeout. If we don't want polling in a loop,
-# the only practical way is using a signal to interrupt the syscall and make it return EINTR.
-# The problem is, how to do this in Python. signal.pthread_kill can be used to send signal to a thread,
-# but the the signal handlers are always called on the main thread.
-# The implementation is a thread pool who would send a signal to the running task on worker thread on timeout.
-# see timed_thread_pool.py. Below are the sequence when a signal is sent to the worker thread.
-#	0. the thread is running the task, possibly blocking in a syscall. Now the thread gets a signal.
-#	1. The CPython signal handler is called on that thread, CPython would record the incoming signal
-#	   and prepare to call its Python handler when back to Python code. The signal handler returns.
-#	2. the syscall got interrupted, returns EINTR, results are collected and goes back to Python code.
-#	3. When backing to Python code, the pending Python signal handler is called on the main thread.
-#	4. If the Python signal handler does not raise and returns, Python code continues to normal flow.
-#	5. In the thread being sent signal, the Python code got the result that syscall is interrupted.
+# We depends on this behavior to detect when video.py has done by trying to also place a flock(2) on it.
+# Instead of parking one thread per BV in a blocking flock(2) and interrupting it by a signal on timeout,
+# all waits are driven by the poll loop on the main thread, see LockWaiter below.
+# The lock holder opens the BV directory to lock it, and the lock is released when that fd is closed.
+# Closing a sub directory is reported by the inotify watch on the video root as IN_CLOSE_NOWRITE | IN_ISDIR,
+# so on every close event of a waited BV, we try flock(2) again with LOCK_NB.
+# A close event could be missed, e.g. on inotify queue overflow or when the fd is shared with a child process,
+# so all waited BVs are also rechecked every LOCK_RECHECK_INTERVAL seconds, which also expires timed out waits.
+# Since flock(2) never blocks here, fcntl.flock() is used directly and no signal is involved.
 #
-# 2. Problem with fcntl.flock
-# Python does provide the flock(2) wrapper as fcntl.flock(). However this wrapper is not usable in this scenaio.
-# According to PEP-0475, Python would auto retry the syscall when interrupted, instead of returning EINTR.
-# The CPython implementation of fcntl.flock() is at Modules/fcntlmodule.c, function fcntl_flock_impl.
-# The condition is "while (ret == -1 && errno == EINTR && !(async_err = PyErr_CheckSignals()))"
-# So in current implementation the flock(2) is auto retried unless the Python signal handler raises.
-# However, since the Python signal handlers are always called in the main thread, raising in the signal handler
-# would be injected into the main thread, instead of the thread being sent signal. This could cause the main
-# thread be interrupted and raise at any point of its code flow, which is hard to handle.
-# The solution is not raising in signal handlers, and to avoid the logic above. We are not using fcntl.flock(),
-# instead using ctypes to grab the flock(2) syscall directly from libc, call it and prepare to handle EINTR.
-#
-# 3. IO priority
+# 2. IO priority
 # On Linux, ionice(1) can start a process using altered IO priority, the underlying syscall is ioprio_set(2).
 # What we want is setting the IO priority of the database worker thread to IOPRIO_CLASS_IDLE, while leaving
 # other threads unchanged. So we cannot start the daemon using ionice(1) since it affects the whole process.
@@ -45,57 +27,40 @@
 
 
 import os
-import errno
-import ctypes
-import ctypes.util
-import struct
+import time
 import select
 import signal
 import logging
 import threading
 
-from errno import EINTR, EWOULDBLOCK
-from fcntl import LOCK_EX, LOCK_SH, LOCK_UN, LOCK_NB
+from stat import S_ISREG
+from fcntl import flock, LOCK_SH, LOCK_NB
 from contextlib import suppress
 from collections import OrderedDict
 
-from video_database import VideoDatabaseManager
+from video_database import VideoDatabaseManager, cid_pattern
 from simple_inotify import *
-from timed_thread_pool import TimedThreadPool
 
 # constants
 
 import constants
 
+# updates arriving within the window are stored in one transaction
+UPDATE_BATCH_WINDOW = 2
+UPDATE_BATCH_SIZE = 0x100
+UPDATE_QUEUE_SIZE = 0x1000
 
-# static object
-
-logger = logging.getLogger("bili_arch.database_daemon")
-
+LOCK_RECHECK_INTERVAL = 10
 
-# flock syscall
+# sizes of watched part directories are written at most once per interval
+PART_SIZE_INTERVAL = 5
+PART_WATCH_MASK = IN_ONLYDIR | IN_CLOSE_WRITE | IN_MOVED_TO | IN_MOVED_FROM | IN_DELETE
 
-libc_path = ctypes.util.find_library('c') or 'libc.so.6'
-libc_instance = ctypes.CDLL(libc_path, use_errno = True)
 
-def check_result(result):
-	if result < 0:
-		errno = ctypes.get_errno()
-		if errno == EINTR:
-			raise InterruptedError()
-		elif errno == EWOULDBLOCK:
-			raise BlockingIOError()
-
-		err_str = ""
-		with suppress(ValueError):
-			err_str = os.strerror(errno)
+# static object
 
-		raise OSError(errno, err_str)
-	return result
+logger = logging.getLogger("bili_arch.database_daemon")
 
-flock = libc_instance.flock
-flock.argtypes = (ctypes.c_int, ctypes.c_int)
-flock.restype = check_result
 
 # classes
 
@@ -147,6 +112,169 @@ class Poll:
 				logger.exception("exception in poll callback")
 
 
+# waits for flock(2) of many directories to be released without blocking,
+# check() on inotify close events, update() rechecks all periodically
+class LockWaiter:
+	def __init__(self, callback, /, interval = LOCK_RECHECK_INTERVAL):
+		self.callback = callback
+		self.interval = interval
+		self.wait_map = {}
+		self.check_time = None
+
+	def __len__(self):
+		return len(self.wait_map)
+
+	def close(self):
+		self.wait_map.clear()
+		self.check_time = None
+
+	def add(self, key, fd, timeout = None):
+		logger.info("waiting on %s", key)
+		self.wait_map[key] = {
+			"fd": fd,
+			"deadline": timeout and (time.monotonic() + timeout),
+		}
+		# may be released before the watch sees it, recheck on next update
+		# callback not called here, caller may hold locks the callback takes
+		self.check_time = time.monotonic()
+
+	def check(self, key):
+		rec = self.wait_map.get(key)
+		if not rec:
+			return
+		try:
+			flock(rec["fd"], LOCK_SH | LOCK_NB)
+			result = True
+		except BlockingIOError:
+			if rec["deadline"] is None or time.monotonic() < rec["deadline"]:
+				return
+			logger.warning("timeout waiting for %s", key)
+			result = False
+		except Exception as e:
+			logger.error("exception waiting for %s: %s", key, e)
+			result = False
+
+		del self.wait_map[key]
+		self.callback(key, result)
+
+	# timeout for Poll.poll
+	def timeout(self):
+		if self.check_time is None:
+			return None
+		return max(self.check_time - time.monotonic(), 0)
+
+	def update(self):
+		if self.check_time is None or time.monotonic() < self.check_time:
+			return
+		logger.debug("rechecking %d locks", len(self.wait_map))
+		for key in list(self.wait_map.keys()):
+			self.check(key)
+		self.check_time = self.wait_map and (time.monotonic() + self.interval) or None
+
+
+# running byte totals of part directories, only the file of each inotify event is stat'ed
+class PartTracker:
+	def __init__(self, observer, video_root):
+		self.observer = observer
+		self.video_root = video_root
+		self.part_map = {}
+		self.bv_map = {}
+		self.dirty_map = {}
+		self.flush_time = None
+
+	def close(self):
+		for bvid in list(self.bv_map.keys()):
+			self.remove_bv(bvid)
+		self.dirty_map.clear()
+
+	def add_bv(self, bvid):
+		with os.scandir(os.path.join(self.video_root, bvid)) as it:
+			for entry in it:
+				if entry.is_dir(follow_symlinks = False) and cid_pattern.fullmatch(entry.name):
+					self.add_part(bvid, entry.name)
+
+	def add_part(self, bvid, cid):
+		part_path = os.path.join(self.video_root, bvid, cid)
+		wd = self.observer.add_watch(part_path, PART_WATCH_MASK)
+		if wd in self.part_map:
+			return
+
+		files = {}
+		with os.scandir(part_path) as it:
+			for entry in it:
+				if entry.is_file(follow_symlinks = False):
+					files[entry.name] = entry.stat(follow_symlinks = False).st_size
+
+		logger.debug("watching part %s/%s", bvid, cid)
+		rec = {
+			"bvid": bvid,
+			"cid": cid,
+			"path": part_path,
+			"files": files,
+			"size": None,
+		}
+		self.part_map[wd] = rec
+		self.bv_map.setdefault(bvid, set()).add(wd)
+		self.update_size(rec)
+
+	def remove_bv(self, bvid):
+		for wd in self.bv_map.pop(bvid, ()):
+			self.part_map.pop(wd, None)
+			with suppress(OSError):
+				self.observer.rm_watch(wd)
+
+	def update_size(self, rec):
+		size = sum(rec["files"].values())
+		if size != rec["size"]:
+			rec["size"] = size
+			self.dirty_map[rec["cid"]] = rec
+			if self.flush_time is None:
+				self.flush_time = time.monotonic() + PART_SIZE_INTERVAL
+
+	# returns False if wd is not a part directory
+	def handle_event(self, ev):
+		rec = self.part_map.get(ev.wd)
+		if not rec:
+			return False
+
+		if ev.mask & IN_IGNORED:
+			self.part_map.pop(ev.wd, None)
+			with suppress(KeyError):
+				self.bv_map[rec["bvid"]].discard(ev.wd)
+			return True
+
+		if not ev.name or ev.mask & IN_ISDIR:
+			return True
+
+		if ev.mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+			try:
+				stat = os.lstat(os.path.join(rec["path"], ev.name))
+				if S_ISREG(stat.st_mode):
+					rec["files"][ev.name] = stat.st_size
+			except FileNotFoundError:
+				rec["files"].pop(ev.name, None)
+		elif ev.mask & (IN_DELETE | IN_MOVED_FROM):
+			rec["files"].pop(ev.name, None)
+
+		self.update_size(rec)
+		return True
+
+	# timeout for Poll.poll
+	def timeout(self):
+		if self.flush_time is None:
+			return None
+		return max(self.flush_time - time.monotonic(), 0)
+
+	# sizes changed since last call, once per PART_SIZE_INTERVAL
+	def update(self):
+		if self.flush_time is None or time.monotonic() < self.flush_time:
+			return None
+		size_list = [{"bvid": rec["bvid"], "cid": rec["cid"], "size": rec["size"]} for rec in self.dirty_map.values()]
+		self.dirty_map.clear()
+		self.flush_time = None
+		return size_list
+
+
 class CacheMonitor:
 	def __init__(self, manager):
 		self.manager = manager
@@ -173,7 +301,7 @@ class CacheMonitor:
 
 		if wd is not None:
 			try:
-				self.manager.unregister(wd)
+				self.manager.unregister(wd, rec["bvid"])
 			except Exception as e:
 				logger.error("cannot unregister wd %d: %s", wd, str(e))
 
@@ -272,23 +400,26 @@ class CacheMonitor:
 
 
 class CacheManager:
-	def __init__(self, video_root, /, database = None, *, num_threads = 64, timeout = 300):
+	def __init__(self, video_root, /, database = None, *, timeout = 300, watch_parts = False):
 		self.video_root = video_root
 		self.monitor = CacheMonitor(self)
 		self.monitor_lock = threading.Lock()
 		self.update_queue = OrderedDict()
 		self.update_cv = threading.Condition()
+		self.update_stats = {"queued": 0, "dedup": 0, "overflow": 0, "batches": 0, "updated": 0}
+		self.size_queue = {}
 		self.database_task = None
 		self.quit = False
 		self.poll = Poll()
 		self.database = VideoDatabaseManager(video_root, database)
 		self.observer = Inotify(IN_NONBLOCK | IN_CLOEXEC)
 		self.root_wd = self.observer.add_watch(video_root, IN_ONLYDIR | IN_ALL_EVENTS)
-		self.wait_pool = TimedThreadPool(signal.SIGALRM, self.poll, num_threads)
+		self.lock_waiter = LockWaiter(self.handle_unlock)
+		self.part_tracker = watch_parts and PartTracker(self.observer, video_root) or None
 		self.timeout = timeout
 		self.needs_walk = False
 		self.poll.register(self.observer.fileno(), self.handle_update)
-		logger.info("video %s, db %s, threads %d, timeout %d", video_root, database or "<none>", num_threads, timeout)
+		logger.info("video %s, db %s, timeout %d, watch parts %s", video_root, database or "<none>", timeout, str(watch_parts))
 
 
 	def close(self):
@@ -301,10 +432,12 @@ class CacheManager:
 			self.monitor.close()
 
 		# close observer
+		if self.part_tracker:
+			self.part_tracker.close()
 		self.observer.close()
 
-		# stop wait_pool
-		self.wait_pool.close()
+		# stop waiting for locks
+		self.lock_waiter.close()
 
 		# stop update thread
 		with self.update_cv:
@@ -316,37 +449,49 @@ class CacheManager:
 
 	def register(self, bvid):
 		video_path = os.path.join(self.video_root, bvid)
-		return self.observer.add_watch(video_path)
+		wd = self.observer.add_watch(video_path)
+		if self.part_tracker:
+			try:
+				self.part_tracker.add_bv(bvid)
+			except OSError as e:
+				logger.error("cannot watch parts of %s: %s", bvid, str(e))
+		return wd
 
 
-	def unregister(self, wd):
+	def unregister(self, wd, bvid = None):
+		if self.part_tracker and bvid:
+			self.part_tracker.remove_bv(bvid)
 		self.observer.rm_watch(wd)
 
 
 	def schedule(self, bvid, fd):
-		self.wait_pool.submit(self.wait_unlock_func, bvid, fd, timeout = self.timeout, nowait = True)
+		self.lock_waiter.add(bvid, fd, timeout = self.timeout)
 
 
-	def wait_unlock_func(self, bvid, fd):
-		logger.info("waiting on %s", bvid)
-		result = False
-		try:
-			flock(fd, LOCK_SH)
-			result = True
-		except InterruptedError:
-			# timeout
-			logger.warning("timeout waiting for %s", bvid)
-			return
-		except Exception as e:
-			logger.error("exception waiting for %s: %s", bvid, e)
-			return
-		finally:
-			with self.monitor_lock:
-				self.monitor.handle_complete(bvid, result)
+	def handle_unlock(self, bvid, result):
+		with self.monitor_lock:
+			self.monitor.handle_complete(bvid, result)
+
+		if result:
+			# video folder successfully unlocked, schedule the update
+			self.queue_update(bvid)
+
 
-		# video folder successfully unlocked, schedule the update
+	def queue_update(self, bvid):
 		logger.info("updating %s", bvid)
 		with self.update_cv:
+			if bvid in self.update_queue:
+				self.update_stats["dedup"] += 1
+			elif len(self.update_queue) >= UPDATE_QUEUE_SIZE:
+				# database falls behind, walking catches up all videos
+				logger.warning("update queue full, walking instead")
+				self.update_stats["overflow"] += 1
+				self.update_queue.clear()
+				self.update_queue["walk"] = True
+				self.update_cv.notify()
+				return
+			else:
+				self.update_stats["queued"] += 1
 			self.update_queue[bvid] = True
 			self.update_queue.move_to_end(bvid, last = True)
 			self.update_cv.notify()
@@ -362,8 +507,14 @@ class CacheManager:
 						# logger.debug("%s: %x", bvid, ev.mask)
 						with self.monitor_lock:
 							self.monitor.handle_bvid(bvid, ev.mask)
+						if ev.mask & IN_CLOSE:
+							self.lock_waiter.check(bvid)
 
+				elif self.part_tracker and self.part_tracker.handle_event(ev):
+					pass
 				else:
+					if self.part_tracker:
+						self.handle_bv_event(ev)
 					with self.monitor_lock:
 						self.monitor.handle_wd(ev.wd, ev.mask)
 
@@ -371,6 +522,30 @@ class CacheManager:
 				logger.exception("exception on event %s 0x%x: %s", ev.name, ev.mask, e)
 
 
+	# new part directories and info.json in a watched BV directory
+	def handle_bv_event(self, ev):
+		with self.monitor_lock:
+			rec = self.monitor.wd_map.get(ev.wd)
+		if not rec:
+			return
+		bvid = rec["bvid"]
+		if ev.mask & IN_ISDIR and ev.mask & (IN_CREATE | IN_MOVED_TO) and cid_pattern.fullmatch(ev.name):
+			self.part_tracker.add_part(bvid, ev.name)
+		elif ev.mask & (IN_CLOSE_WRITE | IN_MOVED_TO) and ev.name == "info.json":
+			# store the video early, so part sizes have rows to go
+			self.queue_update(bvid)
+
+
+	def queue_sizes(self):
+		size_list = self.part_tracker.update()
+		if not size_list:
+			return
+		with self.update_cv:
+			for item in size_list:
+				self.size_queue[item["cid"]] = item
+			self.update_cv.notify()
+
+
 	def database_func(self):
 		try:
 			# Try to change IO priority to IDLE
@@ -384,20 +559,48 @@ class CacheManager:
 		except Exception as e:
 			logger.warning("cannot set IO priority: %s", str(e))
 
-		with self.update_cv:
-			while not self.quit:
-				try:
-					bvid = self.update_queue.popitem(last = False)[0]
-				except KeyError:
-					self.update_cv.wait()
-					continue
+		while not self.quit:
+			with self.update_cv:
+				self.update_cv.wait_for(lambda: self.quit or self.update_queue or self.size_queue)
+				if self.update_queue and "walk" not in self.update_queue:
+					# coalesce updates of a burst
+					self.update_cv.wait_for(lambda: self.quit or "walk" in self.update_queue or len(self.update_queue) >= UPDATE_BATCH_SIZE, timeout = UPDATE_BATCH_WINDOW)
+				if self.quit:
+					break
+
+				if self.update_queue.pop("walk", None):
+					bvid_list = None
+				else:
+					bvid_list = []
+					while self.update_queue and len(bvid_list) < UPDATE_BATCH_SIZE:
+						bvid_list.append(self.update_queue.popitem(last = False)[0])
+				depth = len(self.update_queue)
+				size_list = list(self.size_queue.values())
+				self.size_queue.clear()
+
+			# before update_videos, which scans the parts again
+			if size_list:
 				try:
-					if bvid == "walk":
-						self.database.walk()
-					elif self.database.update_video(bvid):
-						self.database.update_video_size(bvid)
+					self.database.update_part_sizes(size_list)
+					logger.debug("stored sizes of %d parts", len(size_list))
 				except Exception as e:
-					logger.exception("exception on updating %s: %s", bvid, e)
+					logger.exception("exception on updating sizes: %s", e)
+
+			start_time = time.monotonic()
+			try:
+				if bvid_list is None:
+					self.database.walk()
+					continue
+				if not bvid_list:
+					continue
+
+				updated = self.database.update_videos(bvid_list)
+				self.update_stats["batches"] += 1
+				self.update_stats["updated"] += len(updated)
+				logger.info("stored %d of %d videos in %.3f seconds, queue depth %d", len(updated), len(bvid_list), time.monotonic() - start_time, depth)
+				logger.debug("update stats %s", str(self.update_stats))
+			except Exception as e:
+				logger.exception("exception on updating %s: %s", bvid_list or "walk", e)
 
 
 	def __enter__(self):
@@ -413,7 +616,11 @@ class CacheManager:
 		self.database_task = th
 		th.start()
 		while not self.quit:
-			self.poll.poll()
+			timeout_list = [t for t in (self.lock_waiter.timeout(), self.part_tracker and self.part_tracker.timeout()) if t is not None]
+			self.poll.poll(timeout_list and min(timeout_list) or None)
+			self.lock_waiter.update()
+			if self.part_tracker:
+				self.queue_sizes()
 			if self.needs_walk:
 				self.needs_walk = False
 				with self.update_cv:
@@ -431,7 +638,7 @@ class CacheManager:
 def main(args):
 	video_path = args.dir or runtime.subdir("video")
 
-	with CacheManager(video_path, args.database, timeout = args.timeout) as cache_manager:
+	with CacheManager(video_path, args.database, timeout = args.timeout, watch_parts = args.watch_parts) as cache_manager:
 		def sig_walk(signum, frame):
 			cache_manager.walk()
 
@@ -446,6 +653,7 @@ if __name__ == "__main__":
 	args = runtime.parse_args(("dir", ), (
 		(("database", ), {}),
 		(("-t", "--timeout"), {"type": int, "default": 300}),
+		(("--watch-parts", ), {"action": "store_true"}),
 	))
 
 	main(args)
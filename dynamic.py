@@ -9,6 +9,7 @@ import logging
 import core
 import runtime
 import network
+import ratelimit
 
 
 # constants
@@ -66,7 +67,7 @@ async def fetch_user_dynamics(sess, uid, stall = None):
 
 async def main(args):
 	async with network.session() as sess, network.image_fetcher() as img_fetch:
-		stall = runtime.Stall()
+		stall = runtime.Stall(controller = ratelimit.api_backoff)
 		user_root = args.dir or runtime.subdir("user")
 		fetch_detail = runtime.credential and not args.skip_detail
 
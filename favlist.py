@@ -9,6 +9,7 @@ import logging
 import core
 import runtime
 import network
+import ratelimit
 # import video
 
 # constants
@@ -16,6 +17,8 @@ import network
 USER_FAVLIST_URL = "https://api.bilibili.com/x/v3/fav/folder/created/list-all"
 FAVLIST_CONTENT_URL = "https://api.bilibili.com/x/v3/fav/resource/list"
 
+FAVLIST_CACHE_TTL = 600
+
 
 # static objects
 
@@ -30,8 +33,8 @@ async def get_user_favlist(sess, uid):
 	return resp.get("data")
 
 
-async def get_favlist_page(sess, mid, page):
-	resp = await network.request(sess, "GET", FAVLIST_CONTENT_URL, params = {"media_id": mid, "ps": 20, "pn": page})
+async def get_favlist_page(sess, mid, page, stall = None):
+	resp = await network.request(sess, "GET", FAVLIST_CONTENT_URL, stall = stall, cache_ttl = FAVLIST_CACHE_TTL, params = {"media_id": mid, "ps": 20, "pn": page})
 	return resp.get("data")
 
 
@@ -54,9 +57,8 @@ async def fetch_favlist(sess, mid, stall = None):
 	favlist = []
 	page_index = 1
 	while True:
-		stall and await stall()
 		logger.debug("fetching page %d", page_index)
-		favlist_page = await get_favlist_page(sess, mid, page_index)
+		favlist_page = await get_favlist_page(sess, mid, page_index, stall)
 		info = favlist_page.get("info")
 
 		if favlist_info is None:
@@ -91,7 +93,7 @@ async def main(args):
 		import video
 
 	async with network.session() as sess:
-		stall = runtime.Stall()
+		stall = runtime.Stall(controller = ratelimit.api_backoff)
 		mid_list = []
 		for fav_str in args.inputs:
 			if ':' in fav_str:
@@ -134,11 +136,11 @@ async def main(args):
 		logger.info("finish favlist download %d/%d", fetched_favlist, len(mid_list))
 
 		if args.download:
-			await video.batch_download(sess, bv_table, args.dir or runtime.subdir("video"), mode = args.mode, prefer = args.prefer, reject = args.reject)
+			await video.batch_download(sess, bv_table, args.dir or runtime.subdir("video"), mode = args.mode, jobs = args.jobs, parallel = args.parallel, prefer = args.prefer, reject = args.reject)
 
 
 if __name__ == "__main__":
-	args = runtime.parse_args(("network", "auth", "dir", "bandwidth", "video_mode", "prefer"), [
+	args = runtime.parse_args(("network", "auth", "dir", "bandwidth", "jobs", "video_mode", "prefer"), [
 		(("inputs",), {"nargs" : '+'}),
 		(("--download",), {"action": "store_true"}),
 	])
@@ -10,7 +10,7 @@ M3U_HEADER = "#EXTM3U"
 M3U_ENDLIST = "#EXT-X-ENDLIST"
 
 M3U_DURATION_PATTERN = r'#EXT-X-TARGETDURATION:(\d+)'
-M3U_SEQUENCE_PATTERN = r'#EXT-X-MEDIA-SEQUENCE:\d+'
+M3U_SEQUENCE_PATTERN = r'#EXT-X-MEDIA-SEQUENCE:(\d+)'
 M3U_MAP_URI_PATTERN = r'#EXT-X-MAP:URI="(.+)"'
 M3U_STREAM_INF_PATTERN = r'#EXT-X-STREAM-INF:.*BANDWIDTH=(\d+).*'
 
@@ -46,6 +46,11 @@ class M3u:
 		# dict preserve order on python 3.6+
 		self.segments = {}
 		self.duration = 2
+		# media sequence and segment count of last playlist, and
+		# segments that slid out of the window between updates
+		self.sequence = None
+		self.window = 0
+		self.skipped = 0
 
 
 	def parse(self, data):
@@ -55,6 +60,8 @@ class M3u:
 		in_header = True
 		stream_inf = None
 		eos = False
+		sequence = None
+		window = 0
 		while True:
 			line = data.readline()
 			logger.debug(line)
@@ -73,6 +80,10 @@ class M3u:
 				stream_inf = None
 				continue
 
+			seq_match = pattern_sequence.fullmatch(line)
+			if seq_match:
+				sequence = int(seq_match.group(1))
+
 			if line == M3U_ENDLIST:
 				logger.debug("end of stream")
 				eos = True
@@ -105,6 +116,7 @@ class M3u:
 					continue
 
 			if not line.startswith('#'):
+				window += 1
 				if line not in self.segments:
 					logger.debug("new segment %s", line)
 					self.segments[line] = cur_seg
@@ -112,6 +124,12 @@ class M3u:
 				cur_seg = []
 
 		logger.debug("new_segments %d, variant_streams %d", len(result), len(variant_streams))
+		if sequence is not None:
+			if self.sequence is not None and sequence > self.sequence + self.window:
+				logger.debug("skipped segments %d - %d", self.sequence + self.window, sequence)
+				self.skipped += sequence - (self.sequence + self.window)
+			self.sequence = sequence
+			self.window = window
 		if variant_streams and not result:
 			result = sorted(variant_streams, key = (lambda obj: obj["bandwidth"]), reverse = True)[0]
 			logger.debug("variant_streams %d: %s", result["bandwidth"], result["uri"])
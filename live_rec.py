@@ -12,6 +12,8 @@ from contextlib import suppress, AsyncExitStack
 import core
 import runtime
 import network
+import metrics
+import ratelimit
 import hls
 
 # constants
@@ -19,6 +21,11 @@ import hls
 LIVE_STAT_STALL_TIME = 2
 LIVE_STAT_RETRY_COUNT = 5
 
+# HLS segments fetched at the same time
+HLS_SEGMENT_JOBS = 4
+# consecutive failed segments of a host before switching to the next one
+HLS_SEGMENT_FAIL_LIMIT = 3
+
 DEFAULT_PREFER = "ts flv avc"
 DEFAULT_REJECT = "hevc"
 
@@ -121,7 +128,46 @@ async def record_flv(sess, info, name_prefix):
 		raise RuntimeError("record_flv: no valid URL")
 
 
-async def record_hls(sess, info, name_prefix):
+async def fetch_segment(sess, semaphore, url):
+	async with semaphore:
+		return await network.fetch_stream(sess, url)
+
+
+# write segments into archive in playlist order, as soon as each fetch completes
+async def write_segments(archive, m3u, segment_queue, stats):
+	while True:
+		item = await segment_queue.get()
+		if item is None:
+			return
+
+		name, url_index, file_time, start_time, task = item
+		try:
+			data = await task
+		except Exception as e:
+			logger.error("failed to fetch segment %s: %s", name, str(e))
+			stats["failed"] += 1
+			metrics.inc("hls_segment_failed_total")
+			# the poll loop switches host on a streak of failures
+			if stats["fail_host"] != url_index:
+				stats["fail_host"] = url_index
+				stats["fail_streak"] = 0
+			stats["fail_streak"] += 1
+			continue
+
+		with archive.open(zipfile.ZipInfo(name, file_time), "w") as f:
+			f.write(data.getbuffer())
+		stats["written"] += 1
+		stats["fail_streak"] = 0
+
+		# slower than real time, the playlist window may slide past us
+		delay = time.monotonic() - start_time
+		if delay > m3u.duration:
+			logger.warning("segment %s late by %.1f sec", name, delay - m3u.duration)
+			stats["late"] += 1
+			metrics.inc("hls_segment_late_total")
+
+
+async def record_hls(sess, info, name_prefix, *, jobs = HLS_SEGMENT_JOBS):
 	url_info_list = info.get("url_info")
 	last_url_index = 0
 	cur_url_index = 0
@@ -129,21 +175,56 @@ async def record_hls(sess, info, name_prefix):
 		with zipfile.ZipFile(zip_file, mode = "w") as archive:
 			m3u = hls.M3u()
 			stall = None
+			stats = {"written": 0, "missed": 0, "late": 0, "failed": 0, "fail_host": None, "fail_streak": 0}
+			semaphore = asyncio.Semaphore(jobs)
+			# fetched segments wait in memory behind slower ones, bound them
+			segment_queue = asyncio.Queue(maxsize = jobs)
+			writer = asyncio.create_task(write_segments(archive, m3u, segment_queue, stats))
+
+			async def enqueue(item):
+				put_task = asyncio.ensure_future(segment_queue.put(item))
+				try:
+					await asyncio.wait((put_task, writer), return_when = asyncio.FIRST_COMPLETED)
+					if put_task.done():
+						return
+					# writer quit early, raise its exception
+					writer.result()
+					raise RuntimeError("segment writer stopped")
+				except BaseException:
+					put_task.cancel()
+					if item:
+						item[-1].cancel()
+					raise
+
 			try:
 				while True:
 					url_info = url_info_list[cur_url_index]
 					url_path = get_url_path(info.get("base_url"))
 					idx_url = url_info.get("host") + info.get("base_url") + url_info.get("extra")
+					if stats["fail_host"] == cur_url_index and stats["fail_streak"] >= HLS_SEGMENT_FAIL_LIMIT:
+						logger.error("%d segments failed in a row on %s", stats["fail_streak"], url_info.get("host"))
+						stats["fail_streak"] = 0
+						cur_url_index += 1
+						cur_url_index %= len(url_info_list)
+						if cur_url_index == last_url_index:
+							raise RuntimeError("segments failed on all hosts")
+						continue
+
+					new_segments = []
 					try:
+						skipped = m3u.skipped
 						res_list = await m3u.async_update(functools.partial(network.fetch_stream, sess), idx_url)
 						if res_list is None:
 							break
-						file_time = time.gmtime()
+						if m3u.skipped > skipped:
+							logger.warning("missed %d segments", m3u.skipped - skipped)
+							stats["missed"] += m3u.skipped - skipped
+							metrics.inc("hls_segment_missed_total", m3u.skipped - skipped)
+
 						for name in res_list:
-							file_info = zipfile.ZipInfo(name, file_time)
 							url = url_info.get("host") + url_path + name + '?' + url_info.get("extra")
 							logger.debug("%s: %s", name, url)
-							await network.fetch_stream(sess, url, archive.open, file_info, "w")
+							new_segments.append((name, url))
 
 						last_url_index = cur_url_index
 						if not stall:
@@ -158,9 +239,28 @@ async def record_hls(sess, info, name_prefix):
 						else:
 							continue
 
+					# fetched in background, playlist is polled on its own schedule
+					file_time = time.gmtime()
+					start_time = time.monotonic()
+					for name, url in new_segments:
+						task = asyncio.create_task(fetch_segment(sess, semaphore, url))
+						await enqueue((name, cur_url_index, file_time, start_time, task))
+
 					await stall()
 
 			finally:
+				# wait for segments already in the queue
+				try:
+					if not writer.done():
+						await enqueue(None)
+					await writer
+				except Exception:
+					logger.exception("exception on writing segments")
+				while not segment_queue.empty():
+					item = segment_queue.get_nowait()
+					item and item[-1].cancel()
+				logger.info("HLS segments: %d written, %d missed, %d late, %d failed", stats["written"], stats["missed"], stats["late"], stats["failed"])
+
 				file_time = time.gmtime()
 				file_info = zipfile.ZipInfo(core.default_names.hls_index, file_time)
 				with archive.open(file_info, "w") as f:
@@ -215,7 +315,7 @@ async def record_danmaku(rid, path, /, relay_path = None, *, fetch_images = True
 						logger.exception("exception in dispatch danmaku")
 
 
-async def record(sess, rid, path, *, do_record_danmaku = True, relay_path = None, prefer = None, reject = None):
+async def record(sess, rid, path, *, do_record_danmaku = True, relay_path = None, prefer = None, reject = None, segment_jobs = HLS_SEGMENT_JOBS):
 	danmaku_task = None
 	try:
 		logger.debug("record live %d into %s", rid, path)
@@ -240,7 +340,7 @@ async def record(sess, rid, path, *, do_record_danmaku = True, relay_path = None
 			danmaku_task.add_done_callback(asyncio.Task.result)
 
 		stat_fail_count = 0
-		stall = runtime.Stall(LIVE_STAT_STALL_TIME)
+		stall = runtime.Stall(LIVE_STAT_STALL_TIME, controller = ratelimit.api_backoff)
 		while True:
 			start_time = time.time()
 			info = None
@@ -270,7 +370,7 @@ async def record(sess, rid, path, *, do_record_danmaku = True, relay_path = None
 						url_info = norej_info
 
 				if "hls" in url_info.get("protocol_name"):
-					await record_hls(sess, url_info, name_prefix)
+					await record_hls(sess, url_info, name_prefix, jobs = segment_jobs)
 				else:
 					await record_flv(sess, url_info, name_prefix)
 
@@ -310,7 +410,7 @@ async def main(args):
 				if status == 1:
 					rec_name = make_record_name(user_info.get("uname", str(uid)), info.get("title"))
 					with core.locked_path(live_root, rec_name) as rec_path:
-						await record(sess, args.room, rec_path, do_record_danmaku = (not args.no_danmaku), relay_path = args.relay, prefer = args.prefer, reject = args.reject)
+						await record(sess, args.room, rec_path, do_record_danmaku = (not args.no_danmaku), relay_path = args.relay, prefer = args.prefer, reject = args.reject, segment_jobs = args.segment_jobs)
 
 			except Exception:
 				logger.exception("exception on checking")
@@ -330,5 +430,6 @@ if __name__ == "__main__":
 		(("--monitor",),{"action" : "store_true"}),
 		(("--no-danmaku",), {"action" : "store_true"}),
 		(("--relay",), {}),
+		(("--segment-jobs",), {"type" : int, "default" : HLS_SEGMENT_JOBS}),
 	])
 	asyncio.run(main(args))
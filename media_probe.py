@@ -0,0 +1,358 @@
+#!/usr/bin/env python3
+
+import os
+import struct
+import logging
+
+# constants
+
+MP4_CONTAINER_BOXES = (b"moov", b"trak", b"mdia", b"minf", b"stbl", b"mvex")
+MP4_MAX_DEPTH = 8
+
+MP4_HANDLER_TYPES = {
+	b"vide": "video",
+	b"soun": "audio",
+}
+
+MP4_CODEC_NAMES = {
+	b"avc1": "h264",
+	b"avc3": "h264",
+	b"hev1": "hevc",
+	b"hvc1": "hevc",
+	b"av01": "av1",
+	b"vp09": "vp9",
+	b"mp4a": "aac",
+	b"ac-3": "ac3",
+	b"ec-3": "eac3",
+	b"fLaC": "flac",
+	b"Opus": "opus",
+}
+
+FLV_VIDEO_CODECS = {
+	2: "flv1",
+	7: "h264",
+	12: "hevc",
+}
+
+FLV_AUDIO_CODECS = {
+	2: "mp3",
+	10: "aac",
+}
+
+FLV_SCRIPT_TAG = 18
+
+IMAGE_MAGIC = (
+	(b"\xff\xd8\xff", "mjpeg"),
+	(b"\x89PNG\r\n\x1a\n", "png"),
+	(b"GIF87a", "gif"),
+	(b"GIF89a", "gif"),
+	(b"BM", "bmp"),
+)
+
+# static objects
+
+logger = logging.getLogger("bili_arch.media_probe")
+
+class ProbeError(ValueError):
+	pass
+
+# helper functions
+
+def read_exact(f, size):
+	data = f.read(size)
+	if len(data) != size:
+		raise ProbeError("unexpected EOF")
+	return data
+
+
+## MP4
+
+# yields (box_type, payload_offset, box_end) for boxes in [start, end)
+def iter_boxes(f, start, end):
+	offset = start
+	while offset < end:
+		if end - offset < 8:
+			raise ProbeError("truncated box header at %d" % offset)
+		f.seek(offset)
+		size, box_type = struct.unpack(">I4s", read_exact(f, 8))
+		header_size = 8
+		if size == 1:
+			size = struct.unpack(">Q", read_exact(f, 8))[0]
+			header_size = 16
+		elif size == 0:
+			size = end - offset
+
+		if size < header_size or offset + size > end:
+			raise ProbeError("bad box size %d at %d" % (size, offset))
+
+		yield box_type, offset + header_size, offset + size
+		offset += size
+
+
+def read_full_box(f, offset, end, size):
+	f.seek(offset)
+	data = read_exact(f, min(size, end - offset))
+	if len(data) < 4:
+		raise ProbeError("truncated full box")
+	return data[0], data[4:]
+
+
+def parse_time_box(f, offset, end):
+	# mvhd / mdhd, returns (timescale, duration)
+	version, data = read_full_box(f, offset, end, 32)
+	if version == 1:
+		return struct.unpack_from(">IQ", data, 16)
+	else:
+		return struct.unpack_from(">II", data, 8)
+
+
+def parse_sidx(f, offset, end):
+	version, data = read_full_box(f, offset, end, 32)
+	track_id, timescale = struct.unpack_from(">II", data, 0)
+	if not timescale:
+		raise ProbeError("invalid sidx timescale")
+	pos = (version == 1) and 24 or 16
+	count = struct.unpack_from(">H", data, pos + 2)[0]
+	if offset + 4 + pos + 4 + count * 12 > end:
+		raise ProbeError("truncated sidx")
+	f.seek(offset + 4 + pos + 4)
+	entries = read_exact(f, count * 12)
+	duration = sum(struct.unpack_from(">I", entries, i * 12 + 4)[0] for i in range(count))
+	return track_id, timescale, duration
+
+
+def parse_trak(f, start, end, depth = 0):
+	track = {}
+	if depth > MP4_MAX_DEPTH:
+		raise ProbeError("box nested too deep")
+
+	for box_type, offset, box_end in iter_boxes(f, start, end):
+		if box_type in MP4_CONTAINER_BOXES:
+			track.update(parse_trak(f, offset, box_end, depth + 1))
+		elif box_type == b"tkhd":
+			version, data = read_full_box(f, offset, box_end, 24)
+			track["id"] = struct.unpack_from(">I", data, (version == 1) and 16 or 8)[0]
+		elif box_type == b"mdhd":
+			track["timescale"], track["duration"] = parse_time_box(f, offset, box_end)
+		elif box_type == b"hdlr":
+			version, data = read_full_box(f, offset, box_end, 12)
+			track["handler"] = data[4:8]
+		elif box_type == b"stsd":
+			version, data = read_full_box(f, offset, box_end, 16)
+			if struct.unpack_from(">I", data, 0)[0] > 0:
+				track["format"] = data[8:12]
+
+	return track
+
+
+def probe_mp4(f, file_size):
+	movie = None
+	sidx_table = {}
+	for box_type, offset, box_end in iter_boxes(f, 0, file_size):
+		if box_type == b"moov":
+			movie = {"tracks": []}
+			for sub_type, sub_offset, sub_end in iter_boxes(f, offset, box_end):
+				if sub_type == b"mvhd":
+					movie["timescale"], movie["duration"] = parse_time_box(f, sub_offset, sub_end)
+				elif sub_type == b"trak":
+					movie["tracks"].append(parse_trak(f, sub_offset, sub_end))
+				elif sub_type == b"mvex":
+					for ext_type, ext_offset, ext_end in iter_boxes(f, sub_offset, sub_end):
+						if ext_type == b"mehd":
+							version, data = read_full_box(f, ext_offset, ext_end, 12)
+							movie["fragment_duration"] = struct.unpack_from((version == 1) and ">Q" or ">I", data, 0)[0]
+		elif box_type == b"sidx":
+			track_id, timescale, duration = parse_sidx(f, offset, box_end)
+			prev = sidx_table.get(track_id, (timescale, 0))
+			sidx_table[track_id] = (timescale, prev[1] + duration * prev[0] / timescale)
+
+	if not movie or not movie.get("timescale"):
+		raise ProbeError("missing movie header")
+
+	movie_duration = (movie.get("fragment_duration") or movie.get("duration", 0)) / movie["timescale"]
+
+	streams = []
+	for track in movie["tracks"]:
+		codec_type = MP4_HANDLER_TYPES.get(track.get("handler"))
+		if not codec_type:
+			continue
+
+		duration = 0
+		if track.get("duration") and track.get("timescale"):
+			duration = track["duration"] / track["timescale"]
+		if not duration and track.get("id") in sidx_table:
+			timescale, sidx_duration = sidx_table[track.get("id")]
+			duration = sidx_duration / timescale
+		if not duration and len(sidx_table) == 1:
+			timescale, sidx_duration = next(iter(sidx_table.values()))
+			duration = sidx_duration / timescale
+		if not duration:
+			duration = movie_duration
+		if not duration:
+			raise ProbeError("unknown duration for track %s" % track.get("id"))
+
+		streams.append({
+			"index": len(streams),
+			"codec_type": codec_type,
+			"codec_name": MP4_CODEC_NAMES.get(track.get("format"), (track.get("format") or b"").decode(errors = "replace")),
+			"duration": "%f" % duration,
+		})
+
+	if not streams:
+		raise ProbeError("no media track")
+
+	return {
+		"streams": streams,
+		"format": {
+			"format_name": "mov,mp4,m4a,3gp,3g2,mj2",
+			"duration": "%f" % (movie_duration or max(float(s["duration"]) for s in streams)),
+		},
+	}
+
+
+## FLV
+
+def read_amf(data, pos):
+	value_type = data[pos]
+	pos += 1
+	if value_type == 0:
+		return struct.unpack_from(">d", data, pos)[0], pos + 8
+	elif value_type == 1:
+		return bool(data[pos]), pos + 1
+	elif value_type == 2:
+		size = struct.unpack_from(">H", data, pos)[0]
+		return data[pos + 2 : pos + 2 + size].decode(errors = "replace"), pos + 2 + size
+	elif value_type in (3, 8):
+		if value_type == 8:
+			pos += 4
+		result = {}
+		while True:
+			size = struct.unpack_from(">H", data, pos)[0]
+			pos += 2
+			if size == 0 and data[pos] == 9:
+				return result, pos + 1
+			key = data[pos : pos + size].decode(errors = "replace")
+			result[key], pos = read_amf(data, pos + size)
+	elif value_type in (5, 6):
+		return None, pos
+	elif value_type == 10:
+		count = struct.unpack_from(">I", data, pos)[0]
+		pos += 4
+		result = []
+		for i in range(count):
+			value, pos = read_amf(data, pos)
+			result.append(value)
+		return result, pos
+	elif value_type == 11:
+		return struct.unpack_from(">d", data, pos)[0], pos + 10
+	elif value_type == 12:
+		size = struct.unpack_from(">I", data, pos)[0]
+		return data[pos + 4 : pos + 4 + size].decode(errors = "replace"), pos + 4 + size
+	else:
+		raise ProbeError("unsupported AMF type %d" % value_type)
+
+
+def probe_flv(f, file_size):
+	f.seek(0)
+	header = read_exact(f, 9)
+	flags = header[4]
+	header_size = struct.unpack_from(">I", header, 5)[0]
+
+	f.seek(header_size + 4)
+	tag_header = read_exact(f, 11)
+	tag_size = struct.unpack(">I", b"\0" + tag_header[1:4])[0]
+	if (tag_header[0] & 0x1f) != FLV_SCRIPT_TAG:
+		raise ProbeError("missing script tag")
+
+	data = read_exact(f, tag_size)
+
+	# the last PreviousTagSize must point at a complete tag
+	f.seek(file_size - 4)
+	last_size = struct.unpack(">I", read_exact(f, 4))[0]
+	if last_size < 11 or last_size + 4 > file_size - header_size:
+		raise ProbeError("truncated FLV")
+	f.seek(file_size - 4 - last_size)
+	last_header = read_exact(f, 11)
+	if struct.unpack(">I", b"\0" + last_header[1:4])[0] + 11 != last_size:
+		raise ProbeError("truncated FLV")
+
+	try:
+		name, pos = read_amf(data, 0)
+		meta, pos = read_amf(data, pos)
+	except (IndexError, struct.error) as e:
+		raise ProbeError("bad script tag: %s" % str(e))
+
+	if name != "onMetaData" or not isinstance(meta, dict) or not meta.get("duration"):
+		raise ProbeError("missing duration in metadata")
+
+	duration = "%f" % meta.get("duration")
+	streams = []
+	if flags & 0x01:
+		streams.append({
+			"codec_type": "video",
+			"codec_name": FLV_VIDEO_CODECS.get(meta.get("videocodecid"), "unknown"),
+			"duration": duration,
+		})
+	if flags & 0x04:
+		streams.append({
+			"codec_type": "audio",
+			"codec_name": FLV_AUDIO_CODECS.get(meta.get("audiocodecid"), "unknown"),
+			"duration": duration,
+		})
+	for i, s in enumerate(streams):
+		s["index"] = i
+
+	if not streams:
+		raise ProbeError("no media stream")
+
+	return {
+		"streams": streams,
+		"format": {
+			"format_name": "flv",
+			"duration": duration,
+		},
+	}
+
+
+## images
+
+def probe_image(magic):
+	for prefix, codec in IMAGE_MAGIC:
+		if magic.startswith(prefix):
+			return {
+				"streams": [{
+					"index": 0,
+					"codec_type": "video",
+					"codec_name": codec,
+				}],
+				"format": {
+					"format_name": "image2",
+				},
+			}
+
+	raise ProbeError("unknown image format")
+
+# methods
+
+# returns ffprobe-like result from headers only, None if the file cannot be interpreted
+def probe(path):
+	try:
+		with open(path, "rb") as f:
+			file_size = os.fstat(f.fileno()).st_size
+			magic = f.read(12)
+			if magic[4:8] in (b"ftyp", b"styp", b"moov", b"sidx"):
+				result = probe_mp4(f, file_size)
+			elif magic.startswith(b"FLV"):
+				result = probe_flv(f, file_size)
+			else:
+				result = probe_image(magic)
+
+		logger.debug("native probe %s: %d streams", path, len(result["streams"]))
+		return result
+	except (ProbeError, struct.error, OSError) as e:
+		logger.debug("cannot probe %s: %s", path, str(e))
+		return None
+	except Exception as e:
+		# malformed headers must not fail the caller, ffprobe decides instead
+		logger.warning("exception probing %s: %s", path, str(e))
+		return None
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+
+import time
+import atexit
+import logging
+from collections import defaultdict
+
+import core
+
+# constants
+
+METRIC_PREFIX = "bili_arch_"
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+# static objects
+
+logger = logging.getLogger("bili_arch.metrics")
+
+report_interval = None
+report_file = None
+last_report = time.monotonic()
+
+counters = defaultdict(float)
+histograms = {}
+
+# classes
+
+class Histogram:
+	def __init__(self, buckets = LATENCY_BUCKETS):
+		self.buckets = buckets
+		self.counts = [0] * (len(buckets) + 1)
+		self.count = 0
+		self.sum = 0.0
+
+	def observe(self, value):
+		self.count += 1
+		self.sum += value
+		for i, bound in enumerate(self.buckets):
+			if value <= bound:
+				self.counts[i] += 1
+				break
+		else:
+			self.counts[-1] += 1
+
+	def quantile(self, q):
+		target = self.count * q
+		acc = 0
+		for i, c in enumerate(self.counts):
+			acc += c
+			if acc >= target:
+				return self.buckets[i] if i < len(self.buckets) else float("inf")
+		return 0
+
+# helper functions
+
+def make_key(name, labels):
+	return (name, tuple(sorted(labels.items())))
+
+
+def inc(name, value = 1, **labels):
+	counters[make_key(name, labels)] += value
+
+
+def observe(name, value, **labels):
+	key = make_key(name, labels)
+	hist = histograms.get(key)
+	if hist is None:
+		hist = Histogram()
+		histograms[key] = hist
+	hist.observe(value)
+
+
+def format_labels(labels, extra = ()):
+	items = list(labels) + list(extra)
+	if not items:
+		return ""
+	return "{" + ",".join('%s="%s"' % (k, str(v).replace('\\', "\\\\").replace('"', '\\"')) for k, v in items) + "}"
+
+
+def dump_prometheus(out):
+	last_name = None
+	for (name, labels), value in sorted(counters.items()):
+		if name != last_name:
+			out.write("# TYPE %s%s counter\n" % (METRIC_PREFIX, name))
+			last_name = name
+		out.write("%s%s%s %s\n" % (METRIC_PREFIX, name, format_labels(labels), repr(value)))
+
+	for (name, labels), hist in sorted(histograms.items(), key = lambda e: e[0]):
+		if name != last_name:
+			out.write("# TYPE %s%s histogram\n" % (METRIC_PREFIX, name))
+			last_name = name
+		acc = 0
+		for bound, c in zip(hist.buckets + (float("inf"), ), hist.counts):
+			acc += c
+			le = (bound == float("inf")) and "+Inf" or repr(bound)
+			out.write("%s%s_bucket%s %d\n" % (METRIC_PREFIX, name, format_labels(labels, (("le", le), )), acc))
+		out.write("%s%s_sum%s %s\n" % (METRIC_PREFIX, name, format_labels(labels), repr(hist.sum)))
+		out.write("%s%s_count%s %d\n" % (METRIC_PREFIX, name, format_labels(labels), hist.count))
+
+
+def summary():
+	lines = []
+	for (name, labels), hist in sorted(histograms.items(), key = lambda e: e[0]):
+		label_str = " ".join("%s=%s" % e for e in labels)
+		lines.append("%s %s: count %d, mean %.3f sec, p50 <= %s, p90 <= %s" % (name, label_str, hist.count, hist.sum / max(hist.count, 1), hist.quantile(0.5), hist.quantile(0.9)))
+		size_key = make_key(name.replace("_seconds", "_bytes_total"), dict(labels))
+		if size_key in counters:
+			size = counters[size_key]
+			lines.append("%s %s: %d bytes, %.1f KiB/s" % (size_key[0], label_str, size, size / 0x400 / max(hist.sum, 0.001)))
+
+	for (name, labels), value in sorted(counters.items()):
+		if name.endswith("_bytes_total"):
+			continue
+		label_str = " ".join("%s=%s" % e for e in labels)
+		lines.append("%s %s: %g" % (name, label_str, value))
+
+	return lines
+
+
+def report():
+	global last_report
+	last_report = time.monotonic()
+	if report_interval:
+		for line in summary():
+			logger.info(line)
+
+	if report_file:
+		try:
+			with core.staged_file(report_file, "w") as f:
+				dump_prometheus(f)
+		except Exception as e:
+			logger.warning("cannot write metrics to %s: %s", report_file, str(e))
+
+
+def tick():
+	interval = report_interval or (report_file and 60)
+	if interval and time.monotonic() - last_report >= interval:
+		report()
+
+
+def enable(interval = None, path = None):
+	global report_interval
+	global report_file
+	report_interval = interval
+	report_file = path
+	if interval or path:
+		atexit.register(report)
@@ -5,18 +5,24 @@ import re
 import io
 import sys
 import time
+import json
 import httpx
 import socket
 import shutil
 import asyncio
 import logging
 import hashlib
-from contextlib import suppress
+import importlib.util
+from contextlib import suppress, contextmanager
 from urllib.parse import urlencode
 
 import core
 import runtime
+import checksum
 import constants
+import metrics
+import ratelimit
+from response_cache import ResponseCache
 
 # constants
 
@@ -24,6 +30,24 @@ BILI_DOMAIN = ".bilibili.com"
 CHECK_CREDENTIAL_URL = "https://api.bilibili.com/x/web-interface/nav"
 WBI_KEY_URL = "https://api.bilibili.com/x/web-interface/nav"
 
+# wbi keys rotate daily (UTC+8), refresh in background after WBI_KEY_REFRESH_TIME
+WBI_KEY_FILE = "wbi_key.json"
+RESPONSE_CACHE_FILE = "response_cache.db"
+WBI_KEY_REFRESH_TIME = 4 * 3600
+WBI_KEY_TZ_OFFSET = 8 * 3600
+
+HTTP2_HOSTS = ("api.bilibili.com", )
+KEEPALIVE_EXPIRY = 30
+BANDWIDTH_BURST_TIME = 0.5
+
+# risk control / rate limit responses
+RISK_CONTROL_CODES = (-412, -352, -799)
+RISK_CONTROL_STATUS = (412, 429)
+RISK_RETRY_COUNT = 3
+
+SEGMENT_MIN_SIZE = 0x400000
+SEGMENT_RETRY_COUNT = 3
+
 WBI_MIXIN_KEY_ENC_TAB = [
 46, 47, 18,  2, 53,  8, 23, 32,
 15, 50, 10, 31, 58,  3, 45, 35,
@@ -40,10 +64,22 @@ WBI_MIXIN_KEY_ENC_TAB = [
 logger = logging.getLogger("bili_arch.network")
 wbi_pattern = re.compile(r"^.+/([^/.]+)\.[^/.]+$")
 wbi_cached_key = None
+wbi_refresh_task = None
+host_slots = {}
+bandwidth_buckets = {}
+request_buckets = {}
+shared_transports = {}
+response_cache = None
 
 class BiliApiError(RuntimeError):
 	pass
 
+class BiliRiskControlError(BiliApiError):
+	pass
+
+class RangeNotSupportedError(RuntimeError):
+	pass
+
 ## wbi sign
 # https://github.com/SocialSisterYi/bilibili-API-collect/blob/master/docs/misc/sign/wbi.md
 
@@ -75,6 +111,74 @@ async def get_wbi_key(sess):
 	return wbi_key[:32]
 
 
+def wbi_key_date(timestamp):
+	return int((timestamp + WBI_KEY_TZ_OFFSET) // 86400)
+
+
+def load_wbi_key():
+	try:
+		key_path = os.path.join(runtime.cache_dir(), WBI_KEY_FILE)
+		with core.locked_file(key_path, "r") as f:
+			key_info = json.load(f)
+		logger.debug("loaded wbi_key from %s", key_path)
+		return key_info
+	except FileNotFoundError:
+		pass
+	except Exception as e:
+		logger.debug("cannot load wbi_key: %s", str(e))
+
+
+def save_wbi_key(key_info):
+	try:
+		key_path = os.path.join(runtime.cache_dir(), WBI_KEY_FILE)
+		with core.staged_file(key_path, "w") as f:
+			json.dump(key_info, f)
+		logger.debug("saved wbi_key to %s", key_path)
+	except Exception as e:
+		# another process may be writing it
+		logger.debug("cannot save wbi_key: %s", str(e))
+
+
+async def refresh_wbi_key(sess):
+	global wbi_cached_key
+	key_info = {
+		"key": await get_wbi_key(sess),
+		"timestamp": int(time.time()),
+	}
+	wbi_cached_key = key_info
+	save_wbi_key(key_info)
+	return key_info["key"]
+
+
+def on_wbi_refresh_done(task):
+	global wbi_refresh_task
+	wbi_refresh_task = None
+	with suppress(asyncio.CancelledError):
+		if task.exception():
+			logger.warning("failed to refresh wbi_key: %s", str(task.exception()))
+
+
+async def wbi_key(sess):
+	global wbi_cached_key
+	global wbi_refresh_task
+	cur_time = time.time()
+	key_info = wbi_cached_key
+	if not key_info or wbi_key_date(key_info["timestamp"]) != wbi_key_date(cur_time):
+		# other processes may have refreshed the key
+		key_info = load_wbi_key()
+
+	if not key_info or wbi_key_date(key_info["timestamp"]) != wbi_key_date(cur_time):
+		return await refresh_wbi_key(sess)
+
+	wbi_cached_key = key_info
+	if cur_time - key_info["timestamp"] > WBI_KEY_REFRESH_TIME and wbi_refresh_task is None:
+		logger.debug("refreshing wbi_key in background")
+		wbi_refresh_task = asyncio.create_task(refresh_wbi_key(sess))
+		wbi_refresh_task.add_done_callback(on_wbi_refresh_done)
+
+	return key_info["key"]
+
+
 def wbi_sign_request(wbi_key, kwargs):
 	params = kwargs.get("params")
 	if not params:
@@ -93,15 +197,65 @@ def wbi_sign_request(wbi_key, kwargs):
 
 ## requests
 
-def session(credential = None):
+# All sessions in a process share the connection pools, so modules opening
+# their own session still reuse connections and TLS sessions. The pool is
+# closed when the last session using it is closed, and is never reused
+# across fork(2).
+class SharedTransport(httpx.AsyncBaseTransport):
+	def __init__(self, key, transport):
+		self.key = key
+		self.transport = transport
+		self.pid = os.getpid()
+		self.refcount = 0
+
+	@classmethod
+	def get(cls, key, factory):
+		shared = shared_transports.get(key)
+		if shared is None or shared.pid != os.getpid():
+			logger.debug("creating connection pool %s", key)
+			shared = cls(key, factory())
+			shared_transports[key] = shared
+		shared.refcount += 1
+		return shared
+
+	async def handle_async_request(self, request):
+		return await self.transport.handle_async_request(request)
+
+	async def aclose(self):
+		self.refcount -= 1
+		if self.refcount > 0:
+			return
+		if shared_transports.get(self.key) is self:
+			del shared_transports[self.key]
+		logger.debug("closing connection pool %s", self.key)
+		await self.transport.aclose()
+
+
+def make_transport(http2 = False):
+	limits = httpx.Limits(max_connections = runtime.max_connections, max_keepalive_connections = runtime.max_connections, keepalive_expiry = KEEPALIVE_EXPIRY)
+	if http2:
+		if importlib.util.find_spec("h2"):
+			return httpx.AsyncHTTPTransport(limits = limits, http2 = True)
+		logger.warning("h2 package not found, HTTP/2 disabled")
+	return httpx.AsyncHTTPTransport(limits = limits)
+
+
+def session(credential = None, *, timeout = None):
 	if credential is None:
 		credential = runtime.credential
-	timeout = httpx.Timeout(5, connect = runtime.http_timeout)
+	timeout = httpx.Timeout(timeout or 5, connect = runtime.http_timeout)
 	cookies = httpx.Cookies()
 	for k, v in credential.items():
 		cookies.set(k, v, domain = BILI_DOMAIN)
 
-	return httpx.AsyncClient(headers = core.USER_AGENT, timeout = timeout, cookies = cookies, follow_redirects = True)
+	transport = SharedTransport.get("default", make_transport)
+	mounts = None
+	if runtime.http2:
+		mounts = {}
+		for host in HTTP2_HOSTS:
+			mounts["all://" + host] = SharedTransport.get("http2", lambda: make_transport(True))
+
+	return httpx.AsyncClient(headers = core.USER_AGENT, timeout = timeout, cookies = cookies, follow_redirects = True, transport = transport, mounts = mounts)
 
 
 async def check_credential(sess):
@@ -114,38 +268,301 @@ async def check_credential(sess):
 		raise RuntimeError("bad credential %d" % code)
 
 
-async def request(sess, method, url, /, wbi_sign = False, **kwargs):
-	global wbi_cached_key
+def get_response_cache():
+	global response_cache
+	if response_cache is None and runtime.response_cache_size:
+		try:
+			db_file = os.path.join(runtime.cache_dir(), RESPONSE_CACHE_FILE)
+			logger.debug("response cache %s, size %d", db_file, runtime.response_cache_size)
+			response_cache = ResponseCache(db_file, runtime.response_cache_size)
+		except Exception as e:
+			logger.warning("cannot open response cache: %s", str(e))
+			runtime.response_cache_size = None
+	return response_cache
+
+
+# hash of SESSDATA, responses may differ between logged-in users
+def credential_identity(sess):
+	sessdata = None
+	with suppress(Exception):
+		sessdata = sess.cookies.get("SESSDATA")
+	if sessdata:
+		return hashlib.sha256(sessdata.encode()).hexdigest()
+
+
+# cache_ttl enables the response cache for this request, cache_refresh skips
+# the lookup but still stores the response. The cache key uses the unsigned
+# params and the credential identity. The stall is only awaited when the
+# request is sent.
+async def request(sess, method, url, /, wbi_sign = False, risk_retry = RISK_RETRY_COUNT, stall = None, cache_ttl = None, cache_refresh = False, **kwargs):
+	cache = None
+	if cache_ttl and method == "GET":
+		cache = get_response_cache()
+	endpoint = httpx.URL(url).path
+	if cache:
+		cache_key = ResponseCache.make_key(method, url, kwargs.get("params"), credential_identity(sess))
+		if not (cache_refresh or runtime.response_cache_refresh):
+			with suppress(Exception):
+				result = cache.get(cache_key, cache_ttl)
+				if result is not None:
+					metrics.inc("cache_hit_total", endpoint = endpoint)
+					return result
+
 	retry = True
 	while True:
+		stall and await stall()
 		if wbi_sign:
-			if not wbi_cached_key:
-				wbi_cached_key = await get_wbi_key(sess)
-			signed_args = wbi_sign_request(wbi_cached_key, kwargs)
+			signed_args = wbi_sign_request(await wbi_key(sess), kwargs)
 		else:
 			signed_args = kwargs
 
+		await account_request(url)
+		start_time = time.monotonic()
 		response = await sess.request(method, url, **signed_args)
-		response.raise_for_status()
-
-		result = response.json()
-
-		code = result.get("code", -32768)
-		if wbi_sign and retry and "v_voucher" in result.get("data", {}):
-			wbi_cached_key = await get_wbi_key(sess)
+		metrics.observe("request_seconds", time.monotonic() - start_time, endpoint = endpoint)
+		metrics.tick()
+		throttled = response.status_code in RISK_CONTROL_STATUS
+		if throttled:
+			result = {}
+			code = -response.status_code
+			msg = "http status %d" % response.status_code
+		else:
+			response.raise_for_status()
+			result = response.json()
+			code = result.get("code", -32768)
+			msg = result.get("msg") or result.get("message", "")
+			throttled = code in RISK_CONTROL_CODES
+
+		metrics.inc("request_total", endpoint = endpoint, code = code)
+		if throttled:
+			delay = ratelimit.api_backoff.on_throttled()
+			if risk_retry <= 0:
+				logger.error("risk control code %d, msg %s", code, msg)
+				raise BiliRiskControlError(msg)
+			risk_retry -= 1
+			metrics.inc("retry_total", endpoint = endpoint, reason = "risk_control")
+			await asyncio.sleep(delay)
+			continue
+		elif wbi_sign and retry and "v_voucher" in result.get("data", {}):
+			metrics.inc("retry_total", endpoint = endpoint, reason = "v_voucher")
+			await refresh_wbi_key(sess)
 			retry = False
 			continue
 		elif code == 0:
+			ratelimit.api_backoff.on_success()
+			if cache:
+				try:
+					cache.put(cache_key, result)
+				except Exception as e:
+					logger.warning("cannot store response: %s", str(e))
 			return result
 
-		msg = result.get("msg") or result.get("message", "")
 		logger.error("response code %d, msg %s", code, msg)
 		raise BiliApiError(msg)
 
 
-async def fetch(sess, url, path, **kwargs):
+def host_slot(url):
+	host = httpx.URL(url).host
+	slot = host_slots.get(host)
+	if slot is None:
+		logger.debug("host %s, limit %d", host, runtime.host_limit)
+		slot = asyncio.Semaphore(runtime.host_limit)
+		host_slots[host] = slot
+	return slot
+
+
+def endpoint_class(url):
+	host = httpx.URL(url).host
+	if host.endswith("hdslb.com"):
+		return "image"
+	elif host.endswith(BILI_DOMAIN):
+		return "api"
+	else:
+		return "cdn"
+
+
+def bandwidth_bucket(url):
+	table = runtime.bandwidth_limit or {}
+	key = endpoint_class(url)
+	if key not in table:
+		key = "all"
+	limit = table.get(key)
+	if not limit:
+		return None
+
+	bucket = bandwidth_buckets.get(key)
+	if bucket is None:
+		logger.debug("bandwidth limit %s %d B/s", key, limit)
+		bucket = ratelimit.TokenBucket(limit, limit * BANDWIDTH_BURST_TIME)
+		bandwidth_buckets[key] = bucket
+	return bucket
+
+
+# shared by all requests of the endpoint class, the api class also slows down on risk control
+def request_bucket(url):
+	table = runtime.request_rate or {}
+	key = endpoint_class(url)
+	if key not in table:
+		key = "all"
+	rate = table.get(key)
+	if not rate:
+		return None
+
+	bucket = request_buckets.get(key)
+	if bucket is None:
+		logger.debug("request rate %s %.2f/s", key, rate)
+		controller = (key == "api") and ratelimit.api_backoff or None
+		bucket = ratelimit.TokenBucket(rate, runtime.stall_burst, controller = controller)
+		request_buckets[key] = bucket
+	return bucket
+
+
+async def account_request(url):
+	bucket = request_bucket(url)
+	if bucket:
+		wait_time = await bucket.acquire()
+		if wait_time:
+			metrics.inc("throttle_seconds_total", wait_time, endpoint = endpoint_class(url))
+
+
+@contextmanager
+def transfer_metrics(kind, url):
+	endpoint = endpoint_class(url)
+	start_time = time.monotonic()
+	try:
+		yield endpoint
+	except Exception as e:
+		metrics.inc(kind + "_error_total", endpoint = endpoint, error = type(e).__name__)
+		raise
+	else:
+		metrics.observe(kind + "_seconds", time.monotonic() - start_time, endpoint = endpoint)
+	finally:
+		metrics.tick()
+
+
+async def account_chunk(kind, endpoint, bucket, size):
+	metrics.inc(kind + "_bytes_total", size, endpoint = endpoint)
+	if bucket:
+		wait_time = await bucket.acquire(size)
+		if wait_time:
+			metrics.inc("throttle_seconds_total", wait_time, endpoint = endpoint)
+
+
+async def fetch_segmented(sess, url, path, segments, digest = None, **kwargs):
+	async with host_slot(url):
+		resp = await sess.head(url)
+	logger.debug(resp)
+	if not resp.is_success:
+		# some CDNs refuse HEAD but serve GET
+		raise RangeNotSupportedError("status %d on HEAD" % resp.status_code)
+
+	length = resp.headers.get("content-length")
+	if resp.headers.get("accept-ranges") != "bytes" or resp.headers.get("content-encoding") or not length:
+		raise RangeNotSupportedError(url)
+
+	length = int(length)
+	segments = min(segments, length // SEGMENT_MIN_SIZE)
+	if segments < 2:
+		raise RangeNotSupportedError("content length %d too small" % length)
+
+	logger.debug("content length %d, segments %d", length, segments)
+	endpoint = endpoint_class(url)
+	bucket = bandwidth_bucket(url)
+	seg_size = -(-length // segments)
+	# [start, current, end)
+	seg_list = [[i, i, min(i + seg_size, length)] for i in range(0, length, seg_size)]
+
+	async def fetch_range(fd, seg):
+		for i in range(SEGMENT_RETRY_COUNT):
+			try:
+				headers = {"Range": "bytes=%d-%d" % (seg[1], seg[2] - 1)}
+				async with host_slot(url), sess.stream("GET", url, headers = headers) as resp:
+					resp.raise_for_status()
+					if resp.status_code != 206:
+						raise RangeNotSupportedError("status %d on range request" % resp.status_code)
+
+					async for chunk in resp.aiter_bytes():
+						if seg[1] + len(chunk) > seg[2]:
+							raise RuntimeError("segment overflow at %d" % seg[1])
+						os.pwrite(fd, chunk, seg[1])
+						seg[1] += len(chunk)
+						await account_chunk("fetch", endpoint, bucket, len(chunk))
+
+				if seg[1] == seg[2]:
+					return
+				logger.warning("segment %d-%d EOF at %d", seg[0], seg[2], seg[1])
+			except RangeNotSupportedError:
+				raise
+			except Exception as e:
+				logger.warning("segment %d-%d failed at %d: %s", seg[0], seg[2], seg[1], str(e))
+			metrics.inc("retry_total", endpoint = endpoint, reason = "segment")
+
+		raise RuntimeError("unexpected EOF: %s" % path)
+
+	with core.staged_file(path, "wb", **kwargs) as f:
+		f.truncate(length)
+		tasks = [asyncio.create_task(fetch_range(f.fileno(), seg)) for seg in seg_list]
+		try:
+			done, pending = await asyncio.wait(tasks, return_when = asyncio.FIRST_EXCEPTION)
+		finally:
+			for t in tasks:
+				t.cancel()
+			await asyncio.gather(*tasks, return_exceptions = True)
+
+		for t in done:
+			t.result()
+
+		logger.debug("EOF with file length %d", length)
+		if digest:
+			checksum.update_digest(f.fileno(), digest)
+
+	return length
+
+
+def load_resume_info(tmp_name, resume_name):
+	try:
+		with open(resume_name, 'r') as f:
+			resume_info = json.load(f)
+		size = os.path.getsize(tmp_name)
+		if 0 < size < resume_info["length"] and resume_info["validator"]:
+			resume_info["offset"] = size
+			logger.debug("resume info %s", str(resume_info))
+			return resume_info
+	except FileNotFoundError:
+		pass
+	except Exception as e:
+		logger.warning("bad resume info %s: %s", resume_name, str(e))
+
+
+async def fetch(sess, url, path, /, **kwargs):
+	await account_request(url)
+	with transfer_metrics("fetch", url):
+		return await do_fetch(sess, url, path, **kwargs)
+
+
+# digest is updated with the whole file content, including the resumed part
+async def do_fetch(sess, url, path, /, segments = None, resume = False, digest = None, **kwargs):
 	logger.debug("fetching %s into %s", url, path)
-	async with sess.stream("GET", url) as resp:
+	resume_name = path + core.default_names.tmp_ext + core.default_names.resume_ext
+	resume_info = None
+	if resume:
+		resume_info = load_resume_info(path + core.default_names.tmp_ext, resume_name)
+
+	if segments and segments > 1 and not resume_info:
+		try:
+			with suppress(FileNotFoundError):
+				os.remove(resume_name)
+			return await fetch_segmented(sess, url, path, segments, digest, **kwargs)
+		except RangeNotSupportedError as e:
+			logger.debug("fallback to single stream: %s", str(e))
+
+	headers = {}
+	if resume_info:
+		logger.info("resuming %s at %d/%d", path, resume_info["offset"], resume_info["length"])
+		headers["Range"] = "bytes=%d-" % resume_info["offset"]
+		headers["If-Range"] = resume_info["validator"]
+
+	async with host_slot(url), sess.stream("GET", url, headers = headers) as resp:
 		logger.debug(resp)
 		resp.raise_for_status()
 
@@ -157,24 +574,40 @@ async def fetch(sess, url, path, **kwargs):
 		else:
 			logger.warning("missing content-length")
 
-		with core.staged_file(path, "wb", **kwargs) as f:
-			last_timestamp = None
-			if runtime.bandwidth_limit:
-				logger.debug("bandwidth limit %d B/s", runtime.bandwidth_limit)
-				last_timestamp = time.monotonic()
-
+		mode = "wb"
+		offset = 0
+		if resume_info and resp.status_code == 206:
+			content_range = resp.headers.get("content-range")
+			expect_range = "bytes %d-%d/%d" % (resume_info["offset"], resume_info["length"] - 1, resume_info["length"])
+			if content_range != expect_range:
+				raise RuntimeError("content-range mismatch, expect %s got %s" % (expect_range, content_range))
+			mode = "ab"
+			offset = resume_info["offset"]
+			length = resume_info["length"]
+		else:
+			# strong validator only, weak ETag is not allowed in If-Range
+			validator = resp.headers.get("etag")
+			if not validator or validator.startswith("W/"):
+				validator = resp.headers.get("last-modified")
+			if resume and length and validator and not resp.headers.get("content-encoding"):
+				with open(resume_name, 'w') as f:
+					json.dump({"length": length, "validator": validator}, f)
+			else:
+				with suppress(FileNotFoundError):
+					os.remove(resume_name)
+
+		with core.staged_file(path, mode, **kwargs) as f:
+			if f.tell() != offset:
+				raise RuntimeError("tmp file changed, expect %d got %d" % (offset, f.tell()))
+			if digest and offset:
+				checksum.update_digest(f.fileno(), digest, limit = offset)
+
+			endpoint = endpoint_class(url)
+			bucket = bandwidth_bucket(url)
 			async for chunk in resp.aiter_bytes():
 				f.write(chunk)
-
-				if runtime.bandwidth_limit:
-					cur_timestamp = time.monotonic()
-					diff_time = cur_timestamp - last_timestamp
-					expect_time = len(chunk) / runtime.bandwidth_limit
-					wait_time = expect_time - diff_time
-					if diff_time > 0 and wait_time > 0:
-						await asyncio.sleep(wait_time)
-						cur_timestamp = time.monotonic()
-					last_timestamp = cur_timestamp
+				digest and digest.update(chunk)
+				await account_chunk("fetch", endpoint, bucket, len(chunk))
 
 			file_length = f.tell()
 			logger.debug("EOF with file length %d", file_length)
@@ -184,22 +617,28 @@ async def fetch(sess, url, path, **kwargs):
 				if length > file_length:
 					raise RuntimeError("unexpected EOF: %s", path)
 
+	with suppress(FileNotFoundError):
+		os.remove(resume_name)
+
 	return file_length
 
 
 async def fetch_stream(sess, url, sink_func = None, *args):
 	sink = None
+	await account_request(url)
 	try:
-		async with sess.stream("GET", url) as resp:
-			logger.debug(resp)
-			resp.raise_for_status()
-
-			async for chunk in resp.aiter_bytes():
-				if sink is None:
-					logger.debug("calling sink_func")
-					sink = sink_func and sink_func(*args) or io.BytesIO()
-
-				sink.write(chunk)
+		with transfer_metrics("stream", url) as endpoint:
+			async with sess.stream("GET", url) as resp:
+				logger.debug(resp)
+				resp.raise_for_status()
+
+				async for chunk in resp.aiter_bytes():
+					if sink is None:
+						logger.debug("calling sink_func")
+						sink = sink_func and sink_func(*args) or io.BytesIO()
+
+					sink.write(chunk)
+					metrics.inc("stream_bytes_total", len(chunk), endpoint = endpoint)
 
 		if not sink_func:
 			sink.seek(0)
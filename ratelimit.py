@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+
+import time
+import random
+import asyncio
+import logging
+
+# static objects
+
+logger = logging.getLogger("bili_arch.ratelimit")
+
+# classes
+
+# Tokens are reserved before waiting, so concurrent callers line up in
+# calling order without a lock. The bucket may go negative, the deficit
+# is the time the caller has to sleep.
+class TokenBucket:
+	def __init__(self, rate, burst = 1, *, controller = None):
+		self.rate = rate
+		self.burst = burst
+		self.tokens = burst
+		self.last_time = time.monotonic()
+		self.controller = controller
+
+	def current_rate(self):
+		if self.controller:
+			return self.rate * self.controller.scale
+		return self.rate
+
+	def reserve(self, amount):
+		rate = self.current_rate()
+		cur_time = time.monotonic()
+		self.tokens = min(self.burst, self.tokens + (cur_time - self.last_time) * rate)
+		self.last_time = cur_time
+		self.tokens -= amount
+		return max(-self.tokens / rate, 0)
+
+	async def acquire(self, amount = 1):
+		if not self.rate:
+			return 0
+		wait_time = self.reserve(amount)
+		if wait_time > 0:
+			await asyncio.sleep(wait_time)
+		return wait_time
+
+
+# AIMD controller for the request rate. Throttled responses halve the
+# rate and return a jittered exponential delay, each success creeps the
+# rate back up by a fixed step.
+class AdaptiveBackoff:
+	def __init__(self, *, min_scale = 1 / 16, decrease = 0.5, increase = 0.05, base_delay = 10, max_delay = 600):
+		self.min_scale = min_scale
+		self.decrease = decrease
+		self.increase = increase
+		self.base_delay = base_delay
+		self.max_delay = max_delay
+		self.scale = 1.0
+		self.failures = 0
+
+	def on_success(self):
+		self.failures = 0
+		if self.scale < 1.0:
+			self.scale = min(self.scale + self.increase, 1.0)
+			logger.debug("rate scale %.2f", self.scale)
+
+	def on_throttled(self):
+		self.failures += 1
+		self.scale = max(self.scale * self.decrease, self.min_scale)
+		delay = min(self.base_delay * (2 ** (self.failures - 1)), self.max_delay)
+		delay = random.uniform(delay / 2, delay)
+		logger.warning("throttled %d times, rate scale %.2f, backoff %.1f sec", self.failures, self.scale, delay)
+		return delay
+
+
+# static objects
+
+api_backoff = AdaptiveBackoff()
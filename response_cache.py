@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+
+import time
+import json
+import zlib
+import sqlite3
+import logging
+
+# constants
+
+response_table_name = "response_table"
+
+response_table_def = """\
+key TEXT PRIMARY KEY, ctime INTEGER NOT NULL, atime INTEGER NOT NULL, \
+size INTEGER NOT NULL, data BLOB NOT NULL\
+"""
+
+EVICT_BATCH = 0x40
+
+# static objects
+
+logger = logging.getLogger("bili_arch.response_cache")
+
+# classes
+
+# API responses cached in a SQLite database, shared by all processes using
+# the same cache directory. Entries expire by the TTL given on lookup, and
+# the least recently used ones are dropped when exceeding max_size.
+class ResponseCache:
+	# identity separates responses of different credentials
+	@staticmethod
+	def make_key(method, url, params = None, identity = None):
+		return json.dumps([method.upper(), url, sorted((params or {}).items()), identity], ensure_ascii = False)
+
+	def __init__(self, db_file, max_size):
+		self.max_size = max_size
+		self.database = sqlite3.connect(db_file, timeout = 10, isolation_level = None)
+		try:
+			self.database.execute("PRAGMA journal_mode = WAL")
+			self.database.execute("CREATE TABLE IF NOT EXISTS %s (%s) WITHOUT ROWID" % (response_table_name, response_table_def))
+			self.database.execute("CREATE INDEX IF NOT EXISTS %s_atime ON %s (atime)" % (response_table_name, response_table_name))
+		except Exception:
+			self.close()
+			raise
+
+	def __del__(self):
+		self.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+	def close(self):
+		if getattr(self, "database", None) is not None:
+			try:
+				self.database.close()
+			finally:
+				self.database = None
+
+	def get(self, key, ttl):
+		cur_time = int(time.time())
+		row = self.database.execute("SELECT ctime, data FROM %s WHERE key == ?" % response_table_name, (key, )).fetchone()
+		if not row:
+			return None
+		if row[0] + ttl < cur_time:
+			logger.debug("expired %s", key)
+			return None
+
+		self.database.execute("UPDATE %s SET atime = ? WHERE key == ?" % response_table_name, (cur_time, key))
+		logger.debug("hit %s", key)
+		return json.loads(zlib.decompress(row[1]))
+
+	def put(self, key, result):
+		cur_time = int(time.time())
+		data = zlib.compress(json.dumps(result, ensure_ascii = False).encode())
+		self.database.execute("INSERT OR REPLACE INTO %s VALUES (?, ?, ?, ?, ?)" % response_table_name, (key, cur_time, cur_time, len(data), data))
+		self.evict()
+
+	def evict(self):
+		used_size = self.database.execute("SELECT TOTAL(size) FROM %s" % response_table_name).fetchone()[0]
+		while used_size > self.max_size:
+			rows = self.database.execute("SELECT key, size FROM %s ORDER BY atime LIMIT %d" % (response_table_name, EVICT_BATCH)).fetchall()
+			if not rows:
+				break
+			drop_list = []
+			for key, size in rows:
+				drop_list.append((key, ))
+				used_size -= size
+				if used_size <= self.max_size:
+					break
+			logger.debug("evicting %d entries", len(drop_list))
+			self.database.executemany("DELETE FROM %s WHERE key == ?" % response_table_name, drop_list)
@@ -2,20 +2,29 @@
 
 import os
 import re
-import time
-import asyncio
 import logging
 import argparse
 
 import core
+import metrics
+import ratelimit
 
 # static objects
 
 log_level = logging.INFO
 http_timeout = 20
+http2 = False
+max_connections = 32
 default_stall_time = 5
+stall_burst = 1
 bandwidth_limit = None
+request_rate = None
+host_limit = 4
+fetch_segments = None
 root_dir = "."
+cache_root = None
+response_cache_size = None
+response_cache_refresh = False
 credential = {}
 
 logger = logging.getLogger("bili_arch.runtime")
@@ -31,10 +40,25 @@ standard_args = {
 	],
 	"network": [
 		(("-t", "--timeout"), {"type": int}),
+		(("--cache-dir",), {}),
+		(("--response-cache",), {}),
+		(("--refresh-cache",), {"action": "store_true"}),
+		(("--metrics",), {}),
+		(("--metrics-interval",), {"type": float}),
 		(("-s", "--stall"), {"type": float}),
+		(("--burst",), {"type": int}),
+		(("--rate",), {}),
+		(("--http2",), {"action": "store_true"}),
+		(("--max-connections",), {"type": int}),
 	],
 	"bandwidth": [
 		(("-w", "--bandwidth"), {}),
+		(("--segments",), {"type": int}),
+	],
+	"jobs": [
+		(("-j", "--jobs"), {"type": int, "default": 1}),
+		(("--host-limit",), {"type": int}),
+		(("--parallel",), {"action": "store_true"}),
 	],
 	"video_mode": [
 		(("-m", "--mode"), {"choices" : ["fix", "update", "force"], "default": "fix"}),
@@ -62,6 +86,15 @@ def load_credential(auth_file):
 				credential[match.group(1)] = match.group(2)
 
 
+def parse_rate_table(rate_str, parse_func = core.number_with_unit):
+	# "10M" or "cdn=10M,image=1M"
+	table = {}
+	for item in rate_str.split(','):
+		key, sep, value = item.rpartition('=')
+		table[key.strip() or "all"] = parse_func(value.strip())
+	return table
+
+
 ## startup & runtime
 
 def logging_init(level, /, log_file = None, *, no_stderr = False):
@@ -89,9 +122,18 @@ def logging_init(level, /, log_file = None, *, no_stderr = False):
 
 def parse_args(std_args, extra_args = (), *, arg_list = None, opt_auth = False):
 	global http_timeout
+	global http2
+	global max_connections
 	global default_stall_time
+	global stall_burst
 	global bandwidth_limit
+	global request_rate
+	global host_limit
+	global fetch_segments
 	global root_dir
+	global cache_root
+	global response_cache_size
+	global response_cache_refresh
 
 	parser = argparse.ArgumentParser()
 	parser.add_argument("-v", "--verbose", action = "count", default = 0)
@@ -118,12 +160,43 @@ def parse_args(std_args, extra_args = (), *, arg_list = None, opt_auth = False):
 	if getattr(args, "timeout", None):
 		http_timeout = int(args.timeout)
 
+	if getattr(args, "http2", None):
+		http2 = True
+
+	if getattr(args, "max_connections", None):
+		max_connections = int(args.max_connections)
+
+	if getattr(args, "burst", None):
+		stall_burst = max(int(args.burst), 1)
+
 	if getattr(args, "bandwidth", None):
-		bandwidth_limit = core.number_with_unit(args.bandwidth)
+		bandwidth_limit = parse_rate_table(args.bandwidth)
+
+	if getattr(args, "rate", None):
+		# requests per second, "2" or "api=1,image=4"
+		request_rate = parse_rate_table(args.rate, float)
+
+	if getattr(args, "segments", None):
+		fetch_segments = int(args.segments)
+
+	if getattr(args, "host_limit", None):
+		host_limit = int(args.host_limit)
+
+	if getattr(args, "metrics", None) or getattr(args, "metrics_interval", None):
+		metrics.enable(getattr(args, "metrics_interval", None), getattr(args, "metrics", None))
 
 	if getattr(args, "root", None):
 		root_dir = args.root
 
+	if getattr(args, "cache_dir", None):
+		cache_root = args.cache_dir
+
+	if getattr(args, "response_cache", None):
+		response_cache_size = core.number_with_unit(args.response_cache)
+
+	if getattr(args, "refresh_cache", None):
+		response_cache_refresh = True
+
 	logger.debug(args)
 
 	# keep credential safe, load after print
@@ -139,22 +212,16 @@ def parse_args(std_args, extra_args = (), *, arg_list = None, opt_auth = False):
 	return args
 
 
-class Stall:
-	def __init__(self, stall_time = None):
+class Stall(ratelimit.TokenBucket):
+	# API call sites pass ratelimit.api_backoff as controller to slow down on risk control
+	def __init__(self, stall_time = None, burst = None, *, controller = None):
 		self.stall_time = stall_time or default_stall_time
-		self.last_time = 0
-		self.mutex = asyncio.Lock()
+		super().__init__(1 / self.stall_time, burst or stall_burst, controller = controller)
 
 	async def __call__(self):
-		async with self.mutex:
-			cur_time = time.monotonic()
-			time_diff = cur_time - self.last_time
-			time_wait = self.stall_time - time_diff
-			logger.debug("stall %.1f sec",  max(time_wait, 0))
-			if time_diff > 0 and time_wait > 0:
-				await asyncio.sleep(time_wait)
-				cur_time = time.monotonic()
-			self.last_time = cur_time
+		wait_time = await self.acquire()
+		logger.debug("stall %.1f sec", wait_time)
+		metrics.inc("stall_seconds_total", wait_time)
 
 
 def subdir(key):
@@ -163,6 +230,15 @@ def subdir(key):
 	return path
 
 
+def cache_dir():
+	path = cache_root
+	if not path:
+		xdg_path = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+		path = os.path.join(xdg_path, "bili_arch")
+	core.mkdir(path)
+	return path
+
+
 def list_bv(path):
 	bv_list = []
 	for f in os.listdir(path):
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from video_database import VideoDatabaseManager
+
+
+def make_info(bvid, index, mid, uname):
+	return {
+		"bvid": bvid,
+		"title": "video %d" % index,
+		"desc": "",
+		"duration": 10,
+		"ctime": index,
+		"pubdate": index,
+		"videos": 1,
+		"tname": "tag",
+		"pic": "http://i0.hdslb.com/bfs/archive/cover.jpg",
+		"stat": {"view": index, "like": index},
+		# mid is a JSON number in API responses
+		"owner": {"mid": mid, "name": uname, "face": "http://i0.hdslb.com/bfs/face/face.jpg"},
+		"pages": [{"cid": 1000 + index, "page": 1, "part": "p1", "duration": 10}],
+	}
+
+
+class TestSearch(unittest.TestCase):
+	def setUp(self):
+		self.tmp_dir = tempfile.TemporaryDirectory()
+		self.video_root = os.path.join(self.tmp_dir.name, "video")
+		bvid_list = ["BV1xx411c7m%s" % c for c in "ABCD"]
+		for i, bvid in enumerate(bvid_list):
+			bv_root = os.path.join(self.video_root, bvid)
+			os.makedirs(os.path.join(bv_root, str(1000 + i)))
+			with open(os.path.join(bv_root, "info.json"), "w") as f:
+				json.dump(make_info(bvid, i, 100 + i % 2, "用户名%d" % (i % 2)), f, ensure_ascii = False)
+
+		self.database = VideoDatabaseManager(self.video_root, os.path.join(self.tmp_dir.name, "video.db"))
+		self.database.walk()
+
+	def tearDown(self):
+		self.database.close()
+		self.tmp_dir.cleanup()
+
+	def test_uname_search(self):
+		if not self.database.has_search:
+			self.skipTest("no FTS5 trigram support")
+
+		data, count, next_cursor = self.database.query({"uname": ["用户名1"]})
+		self.assertEqual(count, 2)
+		self.assertEqual({item["uname"] for item in data}, {"用户名1"})
+
+	def test_uid_search(self):
+		data, count, next_cursor = self.database.query({"uid": ["100"]})
+		self.assertEqual(count, 2)
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -3,12 +3,12 @@
 import os
 import time
 import signal
-import select
 import logging
 import warnings
 import threading
 from contextlib import suppress
 from collections import deque
+from concurrent.futures import Future
 from functools import partial
 
 # static objects
@@ -23,19 +23,34 @@ def empty_func(*args):
 class ThreadPoolCongestionError(RuntimeError):
 	pass
 
+# Thread pool whose tasks can be interrupted on timeout. When a task runs out of time,
+# signum is sent to its thread, so a blocking syscall returns EINTR. CPython retries most
+# syscalls on EINTR (PEP 475), so tasks need to call the syscall without such wrapper.
+# Timers are timerfds registered to poll once and reused among tasks.
 class TimedThreadPool:
 	# constructor
-	def __init__(self, signum, poll, /, max_threads = None):
+	def __init__(self, signum, poll, /, max_threads = None, max_queue = None):
 		self.poll = poll
 		self.signum = signum
 		self.max_threads = max_threads
+		self.max_queue = max_queue
 		self.all_threads = {}
-		self.idle_threads = deque()
-		# deque itself is atomic, but we need cv for waiting
+		self.idle_count = 0
+		self.task_queue = deque()
+		self.free_timers = deque()
+		self.timer_map = {}
 		self.cv = threading.Condition()
 		self.done_ev = threading.Event()
 		self.done_ev.set()
 		self.quit = False
+		self.stats = {
+			"submitted": 0,
+			"completed": 0,
+			"failed": 0,
+			"timed_out": 0,
+			"wait_time": 0,
+			"run_time": 0,
+		}
 
 		orig_handler = signal.getsignal(signum)
 		if orig_handler is None or orig_handler == signal.SIG_IGN or orig_handler == signal.SIG_DFL:
@@ -45,72 +60,93 @@ class TimedThreadPool:
 
 	# private methods
 
-	def on_timeout(self, worker, *args):
-		tid = worker["thread"].ident
-		print("timeout ", tid)
+	def acquire_timer(self, task):
+		with self.cv:
+			try:
+				timer_fd = self.free_timers.popleft()
+			except IndexError:
+				timer_fd = os.timerfd_create(time.CLOCK_MONOTONIC, flags = os.TFD_NONBLOCK | os.TFD_CLOEXEC)
+				self.poll.register(timer_fd, partial(self.on_timeout, timer_fd))
+				logger.debug("created timer %d", timer_fd)
+			self.timer_map[timer_fd] = task
+		os.timerfd_settime(timer_fd, initial = task["timeout"])
+		return timer_fd
+
+	def release_timer(self, timer_fd):
+		os.timerfd_settime(timer_fd, initial = 0)
 		with suppress(BlockingIOError):
-			os.read(worker["timer"], 8)
-		signal.pthread_kill(tid, self.signum)
+			os.read(timer_fd, 8)
+		with self.cv:
+			del self.timer_map[timer_fd]
+			self.free_timers.append(timer_fd)
 
-	def worker_thread(self, worker):
+	def on_timeout(self, timer_fd, *args):
+		with suppress(BlockingIOError):
+			os.read(timer_fd, 8)
+		with self.cv:
+			task = self.timer_map.get(timer_fd)
+			if not task or task["end_time"] is not None:
+				return
+			task["timed_out"] = True
+			self.stats["timed_out"] += 1
+			# under lock so the signal cannot hit the next task of the thread
+			logger.debug("task timeout on thread %d", task["thread"])
+			signal.pthread_kill(task["thread"], self.signum)
+
+	def run_task(self, task):
+		future = task["future"]
+		if not future.set_running_or_notify_cancel():
+			return
+
+		task["thread"] = threading.get_ident()
+		task["start_time"] = time.monotonic()
+		timer_fd = None
+		try:
+			if task["timeout"]:
+				timer_fd = self.acquire_timer(task)
+			result = task["func"](*task["args"])
+			future.set_result(result)
+		except BaseException as e:
+			logger.debug("exception in task: %s", str(e))
+			future.set_exception(e)
+		finally:
+			with self.cv:
+				task["end_time"] = time.monotonic()
+			if timer_fd is not None:
+				self.release_timer(timer_fd)
+
+		with self.cv:
+			self.stats["wait_time"] += task["start_time"] - task["queue_time"]
+			self.stats["run_time"] += task["end_time"] - task["start_time"]
+			self.stats[future.exception() and "failed" or "completed"] += 1
+
+	def worker_thread(self):
 		tid = threading.get_ident()
-		while not worker["quit"]:
-			worker["event"].wait()
-			worker["event"].clear()
-			payload = worker["payload"]
-			if payload is None:
-				continue
-			worker["payload"] = None
-
-			timeout = payload[0]
-			print("thread ", tid, ", timeout ", timeout)
-			if timeout:
-				os.timerfd_settime(worker["timer"], initial = timeout, interval = timeout)
-			# print(os.timerfd_gettime_ns(worker["timer"]))
-			try:
-				payload[1](*payload[2])
-			except Exception as e:
-				print(e)
-			finally:
-				os.timerfd_settime(worker["timer"], initial = 0)
-				with self.cv:
-					self.idle_threads.append(worker)
-					print("finish", tid, len(self.idle_threads))
-					if len(self.all_threads) == len(self.idle_threads):
+		while True:
+			with self.cv:
+				self.idle_count += 1
+				while not self.task_queue:
+					if len(self.all_threads) == self.idle_count:
 						self.done_ev.set()
-					self.cv.notify()
+					if self.quit or self.all_threads.get(tid) is None:
+						self.idle_count -= 1
+						self.all_threads.pop(tid, None)
+						self.cv.notify_all()
+						return
+					self.cv.wait()
+				self.idle_count -= 1
+				task = self.task_queue.popleft()
+				# room in queue for blocked submitters
+				self.cv.notify_all()
+
+			self.run_task(task)
 
 	def start_thread(self):
-		timer_fd = os.timerfd_create(time.CLOCK_MONOTONIC)
-		worker = {
-			"pool": self,
-			"event": threading.Event(),
-			"timer": timer_fd,
-			"thread": None,
-			"quit": False,
-			"payload": None
-		}
-		thread = threading.Thread(target = self.worker_thread, args = (worker, ))
-		worker["thread"] = thread
-		self.poll.register(timer_fd, partial(self.on_timeout, worker))
-		thread.start()
-		tid = thread.ident
-		self.all_threads[tid] = worker
-		self.idle_threads.appendleft(worker)
-
-		print("created thread ", tid, ", total ", len(self.all_threads))
-
-	def wait_for_worker(self, nowait):
 		# assert(self.cv.locked())
-		if self.max_threads and len(self.all_threads) >= self.max_threads:
-			if nowait:
-				raise ThreadPoolCongestionError("thread pool congestion %d", self.max_threads)
-			else:
-				print("waiting for worker thread")
-				self.cv.wait()
-		else:
-			print("creating worker thread")
-			self.start_thread()
+		thread = threading.Thread(target = self.worker_thread)
+		thread.start()
+		self.all_threads[thread.ident] = thread
+		logger.debug("created thread %d, total %d", thread.ident, len(self.all_threads))
 
 	# public methods
 
@@ -122,53 +158,81 @@ class TimedThreadPool:
 		if not callable(func):
 			raise ValueError("%s is not a callable" % func)
 
-		worker = None
+		task = {
+			"future": Future(),
+			"func": func,
+			"args": args,
+			"timeout": timeout,
+			"thread": None,
+			"timed_out": False,
+			"queue_time": time.monotonic(),
+			"start_time": None,
+			"end_time": None,
+		}
 		with self.cv:
-			while worker is None:
+			while True:
 				if self.quit:
 					raise RuntimeError("thread pool already closed")
-				try:
-					worker = self.idle_threads.popleft()
+				if self.max_queue is None or len(self.task_queue) < self.max_queue:
 					break
-				except IndexError:
-					pass
-				self.wait_for_worker(nowait)
+				if nowait:
+					raise ThreadPoolCongestionError("task queue full %d" % self.max_queue)
+				self.cv.wait()
 
+			self.task_queue.append(task)
+			self.stats["submitted"] += 1
 			self.done_ev.clear()
+			if self.idle_count < len(self.task_queue) and not (self.max_threads and len(self.all_threads) >= self.max_threads):
+				self.start_thread()
+			self.cv.notify()
 
-		assert(worker["payload"] is None)
-		worker["payload"] = (timeout, func, args)
-		worker["event"].set()
+		return task["future"]
 
 	def wait(self, timeout = None):
 		return self.done_ev.wait(timeout)
 
-	def shrink(self, count):
-		while len(self.all_threads) > count:
-			with self.cv:
-				try:
-					worker = self.idle_threads.popleft()
-				except IndexError:
-					break
+	def get_stats(self):
+		with self.cv:
+			stats = dict(self.stats)
+			stats["queued"] = len(self.task_queue)
+			stats["threads"] = len(self.all_threads)
+			stats["running"] = len(self.all_threads) - self.idle_count
+			finished = stats["completed"] + stats["failed"]
+			stats["mean_wait_time"] = finished and stats["wait_time"] / finished
+			stats["mean_run_time"] = finished and stats["run_time"] / finished
+		return stats
 
-				assert(worker["payload"] is None)
-				tid = worker["thread"].ident
-				del self.all_threads[tid]
+	def shrink(self, count):
+		with self.cv:
+			# slots of threads shrunk before but not yet quit are None
+			thread_list = [thread for thread in self.all_threads.values() if thread][count:]
+			for thread in thread_list:
+				# idle worker threads quit when not in all_threads
+				self.all_threads[thread.ident] = None
+			self.cv.notify_all()
 
-			worker["quit"] = True
-			worker["event"].set()
-			worker["thread"].join()
-			timer_fd = worker["timer"]
-			self.poll.unregister(timer_fd)
-			os.close(timer_fd)
+		for thread in thread_list:
+			thread.join()
 
 		return len(self.all_threads)
 
 	def close(self):
-		self.quit = True
-		while len(self.all_threads) > 0:
-			self.wait()
-			self.shrink(0)
+		with self.cv:
+			self.quit = True
+			while self.task_queue:
+				self.task_queue.popleft()["future"].cancel()
+			thread_list = [thread for thread in self.all_threads.values() if thread]
+			self.cv.notify_all()
+
+		for thread in thread_list:
+			thread.join()
+
+		with self.cv:
+			while self.free_timers:
+				timer_fd = self.free_timers.popleft()
+				self.poll.unregister(timer_fd)
+				os.close(timer_fd)
+		self.done_ev.set()
 
 	# context manager
 	def __enter__(self):
@@ -20,6 +20,7 @@ with suppress(ModuleNotFoundError):
 import constants
 import runtime
 import network
+import ratelimit
 
 logger = logging.getLogger("bili_arch.sc_bvid")
 
@@ -90,7 +91,7 @@ if openpyxl:
 
 async def main(args):
 	sess = network.session()
-	stall = runtime.Stall(0.5)
+	stall = runtime.Stall(0.5, controller = ratelimit.api_backoff)
 	if args.format == "xlsx":
 		if not openpyxl:
 			raise RuntimeError("xlsx format requires openpyxl library")
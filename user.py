@@ -10,6 +10,7 @@ from collections import ChainMap
 import core
 import runtime
 import network
+import ratelimit
 from video_collection import fetch_user_collections, gather_bvid_from_collectons
 
 # constants
@@ -87,7 +88,7 @@ async def main(args):
 		import video
 
 	async with network.session() as sess, network.image_fetcher() as img_fetch:
-		stall = runtime.Stall()
+		stall = runtime.Stall(controller = ratelimit.api_backoff)
 		user_root = args.dir or runtime.subdir("user")
 
 		logger.info("fetching %d users", len(args.inputs))
@@ -130,11 +131,11 @@ async def main(args):
 		logger.info("finished user download %d/%d", fetched_user, len(args.inputs))
 
 		if args.download:
-			await video.batch_download(sess, bv_table, args.dir or runtime.subdir("video"), mode = args.mode, prefer = args.prefer, reject = args.reject)
+			await video.batch_download(sess, bv_table, args.dir or runtime.subdir("video"), mode = args.mode, jobs = args.jobs, parallel = args.parallel, prefer = args.prefer, reject = args.reject)
 
 
 if __name__ == "__main__":
-	args = runtime.parse_args(("network", "auth", "dir", "bandwidth", "video_mode", "prefer"), [
+	args = runtime.parse_args(("network", "auth", "dir", "bandwidth", "jobs", "video_mode", "prefer"), [
 		(("inputs",), {"nargs" : '+'}),
 		(("--download",), {"action": "store_true"}),
 	])
@@ -3,10 +3,13 @@
 import os
 import re
 import math
+import time
 import json
 import logging
 import shutil
+import sqlite3
 import subprocess
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 try:
 	from defusedxml.sax import make_parser as xml_make_parser
 except ModuleNotFoundError:
@@ -14,10 +17,19 @@ except ModuleNotFoundError:
 
 import core
 import runtime
+import checksum
+import media_probe
+from verify_cache import VerifyCache
 
 
 logger = logging.getLogger("bili_arch.verify")
 
+VERIFY_CACHE_FILE = "verify_cache.db"
+# files rehashed within this time are not hashed again in deep mode
+DEEP_VERIFY_AGE = 7 * 86400
+verify_cache_enabled = True
+verify_cache = None
+
 ffprobe_bin = shutil.which("ffprobe")
 ffprobe_options = [
 	"-hide_banner",
@@ -29,9 +41,15 @@ ffprobe_options = [
 subtitle_pattern = re.compile(r"subtitle\.(.*)\.json")
 xml_parser = xml_make_parser()
 
+media_ext_table = {
+	".m4v": "V",
+	".m4a": "A",
+	".flv": "",
+}
+
 
 def ffprobe(path):
-	result = {}
+	result = None
 	try:
 		logger.debug("running ffprobe on %s", path)
 		cmdline = [ffprobe_bin]
@@ -48,8 +66,154 @@ def ffprobe(path):
 	return result
 
 
-def verify_media(path, part_duration, duration_tolerance):
-	media_info = ffprobe(path)
+# header-only parser first, ffprobe for files it cannot interpret
+# None if neither can, or ffprobe is not installed
+def probe_file(path):
+	result = media_probe.probe(path)
+	if result is None and ffprobe_bin:
+		result = ffprobe(path)
+	return result
+
+
+def get_verify_cache():
+	global verify_cache
+	global verify_cache_enabled
+	if verify_cache is None and verify_cache_enabled:
+		try:
+			db_file = os.path.join(runtime.cache_dir(), VERIFY_CACHE_FILE)
+			logger.debug("verify cache %s", db_file)
+			verify_cache = VerifyCache(db_file)
+		except Exception as e:
+			logger.warning("cannot open verify cache: %s", str(e))
+			verify_cache_enabled = False
+	return verify_cache
+
+
+# the cache is only a shortcut, errors (e.g. locked by other workers) are misses
+def cache_get(cache, path, stat, kind):
+	if not cache:
+		return None
+	try:
+		return cache.get(path, stat, kind)
+	except sqlite3.Error as e:
+		logger.warning("cannot read verify cache: %s", str(e))
+
+
+def cache_put(cache, path, stat, kind, result):
+	if not cache:
+		return
+	try:
+		cache.put(path, stat, kind, result)
+	except sqlite3.Error as e:
+		logger.warning("cannot write verify cache: %s", str(e))
+
+
+# check_func returns None on failures which should not be cached
+def cached_check(path, kind, check_func, stat = None):
+	cache = get_verify_cache()
+	if not cache:
+		return check_func(path)
+
+	stat = stat or os.stat(path)
+	result = cache_get(cache, path, stat, kind)
+	if result is None:
+		result = check_func(path)
+		if result is not None:
+			cache_put(cache, path, stat, kind, result)
+	return result
+
+
+def probe_media(path, stat = None):
+	return cached_check(path, "probe", probe_file, stat)
+
+
+def check_xml(path):
+	try:
+		with open(path, "r") as f:
+			xml_parser.parse(f)
+		return True
+	except Exception:
+		return False
+
+
+def check_json(path):
+	try:
+		with open(path, "r") as f:
+			json.load(f)
+		return True
+	except Exception:
+		return False
+
+
+def prefetch_probes(executor, snapshot, bv_info, ignore):
+	file_list = []
+	cover_name = os.path.split(bv_info.get("pic", ""))[1]
+	if cover_name and 'C' not in ignore and cover_name in snapshot.files:
+		file_list.append((snapshot, cover_name))
+
+	if 'P' in ignore:
+		part_list = []
+	elif "interactive" in bv_info:
+		part_list = bv_info.get("interactive").get("nodes")
+	else:
+		part_list = bv_info.get("pages")
+
+	for part in part_list:
+		part_snapshot = snapshot.dirs.get(str(part.get("cid", "")))
+		if not part_snapshot:
+			continue
+		for filename in part_snapshot.files:
+			media_type = media_ext_table.get(os.path.splitext(filename)[1].lower())
+			if media_type is None:
+				continue
+			if media_type and media_type in ignore:
+				continue
+			if not media_type and 'V' in ignore and 'A' in ignore:
+				continue
+			file_list.append((part_snapshot, filename))
+
+	cache = get_verify_cache()
+	probes = {}
+	for dir_snapshot, filename in file_list:
+		path = os.path.join(dir_snapshot.path, filename)
+		if cache_get(cache, path, dir_snapshot.stat(filename), "probe") is not None:
+			continue
+		probes[path] = executor.submit(probe_file, path)
+
+	logger.debug("prefetch %d/%d probes", len(probes), len(file_list))
+	return probes
+
+
+def verify_checksum(path, entry, rate = None, max_age = None, stat = None):
+	stat = stat or os.stat(path)
+	if stat.st_size != entry.get("size"):
+		logger.warning("size mismatch, %d/%d", stat.st_size, entry.get("size"))
+		return False
+
+	cache = get_verify_cache()
+	result = cache_get(cache, path, stat, "checksum")
+	if result and max_age and time.time() - result.get("time", 0) < max_age:
+		logger.debug("recently hashed %s", path)
+	else:
+		try:
+			size, digest = checksum.hash_file(path, rate = rate)
+		except OSError as e:
+			# fails this file only, not the whole BV
+			logger.warning("cannot hash %s: %s", path, str(e))
+			return False
+		result = {"digest": digest, "time": int(time.time())}
+		cache_put(cache, path, stat, "checksum", result)
+
+	return result.get("digest") == entry.get(checksum.CHECKSUM_ALGORITHM)
+
+
+# returns (video_count, audio_count), or None if the file cannot be scanned
+def verify_media(path, part_duration, duration_tolerance, probe = probe_media, stat = None):
+	media_info = probe(path, stat)
+	if media_info is None and not ffprobe_bin:
+		logger.warning("cannot scan %s without ffprobe", path)
+		return None
+	media_info = media_info or {}
 	try:
 		vc = 0
 		ac = 0
@@ -82,16 +246,18 @@ def verify_media(path, part_duration, duration_tolerance):
 		return 0, 0
 
 
-def verify_cover(path, name, scan_files):
-	cover_path = os.path.join(path, name)
+def verify_cover(snapshot, name, scan_files, probe = probe_media):
+	cover_path = os.path.join(snapshot.path, name)
 	logger.debug("checking cover %s", cover_path)
-	if not os.path.isfile(cover_path):
+	if name not in snapshot.files:
 		return False
 
-	if scan_files:
-		media_info = ffprobe(cover_path)
+	media_info = scan_files and probe(cover_path, snapshot.stat(name))
+	if scan_files and media_info is None and not ffprobe_bin:
+		logger.warning("cannot scan %s without ffprobe", cover_path)
+	elif scan_files:
 		try:
-			codec = media_info.get("streams")[0].get("codec_name")
+			codec = (media_info or {}).get("streams")[0].get("codec_name")
 			logger.debug("cover codec %s", codec)
 			if codec not in ["mjpeg", "png", "gif", "bmp"]:
 				return False
@@ -104,30 +270,38 @@ def verify_cover(path, name, scan_files):
 	return True
 
 
-def verify_bv(bv_root, *, ignore = "", autoremove = None, scan_files = False, duration_tolerance = None):
+def verify_bv(bv_root, *, ignore = "", autoremove = None, scan_files = False, duration_tolerance = None, probe_jobs = 1, deep = False, deep_rate = None, deep_age = DEEP_VERIFY_AGE):
 	if scan_files and not ffprobe_bin:
-		logger.warning("ffprobe binary not found")
-		scan_files = False
+		logger.warning("ffprobe binary not found, only scan files with known headers")
 
 	result = {
 		"info" : False,
 		"parts" : {}
 	}
+	executor = None
+	probes = {}
+	probe = probe_media
 	try:
 		logger.debug("verify video %s, scan %s, tolerance %.1f", bv_root, scan_files, duration_tolerance or math.nan)
 		if ignore:
 			logger.debug("ignore %s", ignore)
+		snapshot = core.dir_snapshot(bv_root)
 		logger.debug("loading video info")
 		with open(os.path.join(bv_root, "info.json"), 'r') as f:
 			bv_info = json.load(f)
 
 		logger.info("%s, %s", bv_info.get("bvid"), bv_info.get("title"))
 
+		if scan_files and probe_jobs > 1:
+			executor = ThreadPoolExecutor(probe_jobs)
+			probes = prefetch_probes(executor, snapshot, bv_info, ignore)
+			probe = lambda path, stat = None: cached_check(path, "probe", lambda p: probes[p].result() if p in probes else probe_file(p), stat)
+
 		if 'C' not in ignore:
 			result["cover"] = False
 
 			cover_name = os.path.split(bv_info.get("pic", ""))[1]
-			if cover_name and verify_cover(bv_root, cover_name, scan_files):
+			if cover_name and verify_cover(snapshot, cover_name, scan_files, probe):
 				result["cover"] = True
 			else:
 				logger.warning("cover not found")
@@ -142,7 +316,7 @@ def verify_bv(bv_root, *, ignore = "", autoremove = None, scan_files = False, du
 
 			logger.debug("interactive video, checking graph")
 			# TODO scan DOT file
-			result["graph"] = os.path.isfile(os.path.join(bv_root, "graph.dot"))
+			result["graph"] = "graph.dot" in snapshot.files
 		else:
 			part_list = bv_info.get("pages")
 			if bv_info.get("videos") != len(part_list):
@@ -177,7 +351,8 @@ def verify_bv(bv_root, *, ignore = "", autoremove = None, scan_files = False, du
 					part_stat['S'] = 0
 
 			part_root = os.path.join(bv_root, cid)
-			if not os.path.isdir(part_root):
+			part_snapshot = snapshot.dirs.get(cid)
+			if not part_snapshot:
 				logger.debug("part dir not exist")
 				continue
 
@@ -186,15 +361,25 @@ def verify_bv(bv_root, *, ignore = "", autoremove = None, scan_files = False, du
 			no_audio = False
 			no_video = False
 
+			manifest = {}
+			if deep and core.default_names.checksum in part_snapshot.files:
+				try:
+					manifest = checksum.load_manifest(part_root)
+				except Exception as e:
+					logger.warning("bad checksum manifest: %s", str(e))
+
 			logger.debug("checking %s in %s", cid, part_root)
-			for filename in os.listdir(part_root):
+			for filename in part_snapshot.files:
 				logger.debug("file %s", filename)
 				ext = os.path.splitext(filename)[1].lower()
 
-				if ext == core.default_names.tmp_ext:
+				if ext in (core.default_names.tmp_ext, core.default_names.resume_ext):
 					logger.debug("skip tmp file")
 					continue
 
+				if filename == core.default_names.checksum:
+					continue
+
 				if filename == core.default_names.novideo:
 					logger.info("found no-video stub")
 					no_video = True
@@ -207,13 +392,9 @@ def verify_bv(bv_root, *, ignore = "", autoremove = None, scan_files = False, du
 
 				if filename == core.default_names.danmaku and 'D' not in ignore:
 					logger.debug("type: danmaku")
-					if scan_files:
-						try:
-							with open(os.path.join(part_root, filename), "r") as f:
-								xml_parser.parse(f)
-						except Exception:
-							logger.warning("unexpected XML format")
-							continue
+					if scan_files and not cached_check(os.path.join(part_root, filename), "xml", check_xml, part_snapshot.stat(filename)):
+						logger.warning("unexpected XML format")
+						continue
 
 					logger.debug("found danmaku")
 					part_stat['D'] += 1
@@ -228,13 +409,9 @@ def verify_bv(bv_root, *, ignore = "", autoremove = None, scan_files = False, du
 					if 'S' not in ignore:
 						lan = match.group(1)
 						logger.debug("type: subtitle %s", lan)
-						if scan_files:
-							try:
-								with open(os.path.join(part_root, filename), "r") as f:
-									json.load(f)
-							except Exception:
-								logger.warning("unexpected JSON format")
-								continue
+						if scan_files and not cached_check(os.path.join(part_root, filename), "json", check_json, part_snapshot.stat(filename)):
+							logger.warning("unexpected JSON format")
+							continue
 
 						logger.debug("found subtitle, lang %s", lan)
 						for i, sub in enumerate(subtitle):
@@ -250,11 +427,15 @@ def verify_bv(bv_root, *, ignore = "", autoremove = None, scan_files = False, du
 				if 'V' in ignore and 'A' in ignore:
 					continue
 
+				if filename in manifest and not verify_checksum(os.path.join(part_root, filename), manifest[filename], deep_rate, deep_age, part_snapshot.stat(filename)):
+					logger.warning("checksum mismatch")
+					continue
+
 				if ext == ".m4v" and 'V' not in ignore:
 					logger.debug("type: video")
 					if scan_files:
-						vc, ac = verify_media(os.path.join(part_root, filename), part_duration, duration_tolerance)
-						if vc != 1 or ac != 0:
+						media_count = verify_media(os.path.join(part_root, filename), part_duration, duration_tolerance, probe, part_snapshot.stat(filename))
+						if media_count is not None and media_count != (1, 0):
 							logger.warning("unexpected media streams")
 							continue
 
@@ -265,8 +446,8 @@ def verify_bv(bv_root, *, ignore = "", autoremove = None, scan_files = False, du
 				if ext == ".m4a" and 'A' not in ignore:
 					logger.debug("type: audio")
 					if scan_files:
-						vc, ac = verify_media(os.path.join(part_root, filename), part_duration, duration_tolerance)
-						if vc != 0 or ac != 1:
+						media_count = verify_media(os.path.join(part_root, filename), part_duration, duration_tolerance, probe, part_snapshot.stat(filename))
+						if media_count is not None and media_count != (0, 1):
 							logger.warning("unexpected media streams")
 							continue
 
@@ -277,8 +458,8 @@ def verify_bv(bv_root, *, ignore = "", autoremove = None, scan_files = False, du
 				if ext == ".flv":
 					logger.debug("type: flv")
 					if scan_files:
-						vc, ac = verify_media(os.path.join(part_root, filename), part_duration, duration_tolerance)
-						if vc != 1 or ac != 1:
+						media_count = verify_media(os.path.join(part_root, filename), part_duration, duration_tolerance, probe, part_snapshot.stat(filename))
+						if media_count is not None and media_count != (1, 1):
 							logger.warning("unexpected media streams")
 							continue
 
@@ -317,6 +498,11 @@ def verify_bv(bv_root, *, ignore = "", autoremove = None, scan_files = False, du
 		result["info"] = True
 	except Exception as e:
 		logger.exception("exception in verifing %s", bv_root)
+	finally:
+		if executor:
+			for future in probes.values():
+				future.cancel()
+			executor.shutdown()
 
 	logger.debug(result)
 	return result
@@ -336,6 +522,10 @@ def check_result(stat):
 
 
 def main(args):
+	global verify_cache_enabled
+	if args.no_cache:
+		verify_cache_enabled = False
+
 	video_root = args.dir or runtime.subdir("video")
 	if len(args.inputs) > 0:
 		logger.debug("%d BV on cmdline", len(args.inputs))
@@ -350,15 +540,43 @@ def main(args):
 	if tolerance:
 		tolerance = float(tolerance)
 
+	verify_args = {
+		"ignore": args.ignore,
+		"scan_files": args.scan,
+		"duration_tolerance": tolerance,
+		# threads probing files of one BV, in each of the --jobs processes
+		"probe_jobs": max(args.probe_jobs, 1),
+		"deep": args.deep,
+		"deep_rate": args.deep_rate and core.number_with_unit(args.deep_rate),
+		"deep_age": args.deep_age * 86400,
+	}
+
 	verified_count = 0
-	for bv in bv_list:
-		bv_root = os.path.join(video_root, bv)
-		result = verify_bv(bv_root, ignore = args.ignore, scan_files = args.scan, duration_tolerance = tolerance)
-		res = check_result(result)
-		if res:
-			verified_count += 1
+	if args.jobs > 1:
+		logger.debug("verify with %d jobs", args.jobs)
+		with ProcessPoolExecutor(args.jobs, initializer = runtime.logging_init, initargs = (runtime.log_level, args.log)) as executor:
+			future_table = {executor.submit(verify_bv, os.path.join(video_root, bv), **verify_args): bv for bv in bv_list}
+			for future in as_completed(future_table):
+				bv = future_table[future]
+				try:
+					res = check_result(future.result())
+				except Exception as e:
+					logger.error("worker failed on %s: %s", bv, str(e))
+					res = False
+
+				if res:
+					verified_count += 1
+
+				runtime.report("video", res, bv)
+	else:
+		for bv in bv_list:
+			bv_root = os.path.join(video_root, bv)
+			result = verify_bv(bv_root, **verify_args)
+			res = check_result(result)
+			if res:
+				verified_count += 1
 
-		runtime.report("video", res, bv)
+			runtime.report("video", res, bv)
 
 	logger.info("finished verify video %d/%d", verified_count, len(bv_list))
 
@@ -369,5 +587,12 @@ if __name__ == "__main__":
 		(("--scan",), {"action" : "store_true"}),
 		(("--tolerance",), {"type" : float}),
 		(("--ignore",), {"default": ""}),
+		(("-j", "--jobs"), {"type": int, "default": 1}),
+		(("--probe-jobs",), {"type": int, "default": 1}),
+		(("--cache-dir",), {}),
+		(("--no-cache",), {"action": "store_true"}),
+		(("--deep",), {"action": "store_true"}),
+		(("--deep-rate",), {}),
+		(("--deep-age",), {"type": float, "default": DEEP_VERIFY_AGE / 86400}),
 	])
 	main(args)
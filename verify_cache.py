@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import sqlite3
+import logging
+
+# constants
+
+verify_table_name = "verify_table"
+
+verify_table_def = """\
+path TEXT NOT NULL, kind TEXT NOT NULL, size INTEGER NOT NULL, \
+mtime INTEGER NOT NULL, inode INTEGER NOT NULL, data TEXT NOT NULL, \
+PRIMARY KEY (path, kind)\
+"""
+
+# static objects
+
+logger = logging.getLogger("bili_arch.verify_cache")
+
+# classes
+
+# results of file checks (ffprobe output, XML/JSON validity) keyed by path,
+# only valid while size, mtime and inode of the file stay the same.
+class VerifyCache:
+	def __init__(self, db_file):
+		self.database = sqlite3.connect(db_file, timeout = 10, isolation_level = None)
+		try:
+			self.database.execute("PRAGMA journal_mode = WAL")
+			self.database.execute("PRAGMA synchronous = NORMAL")
+			self.database.execute("CREATE TABLE IF NOT EXISTS %s (%s) WITHOUT ROWID" % (verify_table_name, verify_table_def))
+		except Exception:
+			self.close()
+			raise
+
+	def __del__(self):
+		self.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+	def close(self):
+		if getattr(self, "database", None) is not None:
+			try:
+				self.database.close()
+			finally:
+				self.database = None
+
+	def get(self, path, stat, kind):
+		row = self.database.execute("SELECT size, mtime, inode, data FROM %s WHERE path == ? AND kind == ?" % verify_table_name, (os.path.abspath(path), kind)).fetchone()
+		if not row:
+			return None
+		if tuple(row[0:3]) != (stat.st_size, stat.st_mtime_ns, stat.st_ino):
+			logger.debug("stale %s %s", kind, path)
+			return None
+
+		logger.debug("hit %s %s", kind, path)
+		return json.loads(row[3])
+
+	def put(self, path, stat, kind, result):
+		data = json.dumps(result, ensure_ascii = False)
+		self.database.execute("INSERT OR REPLACE INTO %s VALUES (?, ?, ?, ?, ?, ?)" % verify_table_name, (os.path.abspath(path), kind, stat.st_size, stat.st_mtime_ns, stat.st_ino, data))
@@ -11,7 +11,9 @@ import collections
 import core
 import runtime
 import network
+import ratelimit
 import verify
+import checksum
 
 # constants
 
@@ -22,6 +24,8 @@ BV_INFO_URL = "https://api.bilibili.com/x/web-interface/view"
 DANMAKU_URL = "https://comment.bilibili.com/%s.xml"
 PLAY_INFO_URL = "https://api.bilibili.com/x/player/playurl"
 
+BV_INFO_CACHE_TTL = 3600
+
 # static objects
 
 codec_name_map = collections.defaultdict(lambda: "unknown", [
@@ -35,8 +39,9 @@ logger = logging.getLogger("bili_arch.video")
 
 # helper functions
 
-async def get_bv_info(sess, bvid):
-	resp = await network.request(sess, "GET", BV_INFO_URL, params = {"bvid": bvid})
+# refresh bypasses cached responses, for up-to-date info
+async def get_bv_info(sess, bvid, stall = None, refresh = False):
+	resp = await network.request(sess, "GET", BV_INFO_URL, stall = stall, cache_ttl = BV_INFO_CACHE_TTL, cache_refresh = refresh, params = {"bvid": bvid})
 	return resp.get("data")
 
 
@@ -138,10 +143,9 @@ async def fetch_interactive_info(sess, info, stall = None):
 	raise NotImplementedError("interactive video not implemented")
 
 
-async def fetch_info(sess, bv, /, stall = None):
+async def fetch_info(sess, bv, /, stall = None, refresh = False):
 	logger.debug("fetch video info %s", bv)
-	stall and await stall()
-	info = await get_bv_info(sess, bv)
+	info = await get_bv_info(sess, bv, stall, refresh)
 	part_list = None
 
 	if is_interactive(info):
@@ -165,7 +169,7 @@ async def fetch_info(sess, bv, /, stall = None):
 	return info
 
 
-async def fetch_part(sess, bvid, cid, path, force, /, stall = None, *, request = "VA", prefer = None, reject = None):
+async def fetch_part(sess, bvid, cid, path, force, /, stall = None, *, request = "VA", prefer = None, reject = None, parallel = False):
 	logger.debug("fetch part for %s, path %s, force %x", cid, path, force)
 	stall and await stall()
 	play_info = await get_play_info(sess, bvid, cid)
@@ -189,25 +193,48 @@ async def fetch_part(sess, bvid, cid, path, force, /, stall = None, *, request =
 	if components != request:
 		logger.warning("missing components %s/%s", components, request)
 
-	exception = None
-	for name, url_list in url_info.items():
+	async def fetch_file(name, url_list):
 		file_path = os.path.join(path, name)
 		if (not force) and os.path.isfile(file_path):
-			continue
+			return
 
 		if not url_list:
 			core.touch(file_path)
-			continue
+			return
 
-		for url in url_list:
+		for i, url in enumerate(url_list):
 			try:
-				stall and await stall()
-				await network.fetch(sess, url, file_path)
+				# in parallel mode the streams start right after play_info,
+				# only stall before trying backup URLs
+				if i > 0 or not parallel:
+					stall and await stall()
+				digest = checksum.new_digest()
+				size = await network.fetch(sess, url, file_path, segments = runtime.fetch_segments, resume = True, digest = digest)
 				break
 			except Exception:
 				logger.exception("failed to fetch part %s", cid)
 		else:
-			exception = Exception("cannot fetch %s:%s:%s after %d attempts" % (bvid, cid, name, len(url_list)))
+			raise Exception("cannot fetch %s:%s:%s after %d attempts" % (bvid, cid, name, len(url_list)))
+
+		# the file is fetched anyway, deep verify just skips it without a checksum
+		try:
+			checksum.update_manifest(path, name, size, digest.hexdigest())
+		except Exception:
+			logger.exception("failed to update checksum of %s", file_path)
+
+	exception = None
+	if parallel:
+		logger.debug("fetching %d streams in parallel", len(url_info))
+		results = await asyncio.gather(*(fetch_file(name, url_list) for name, url_list in url_info.items()), return_exceptions = True)
+		for res in results:
+			if isinstance(res, Exception):
+				exception = res
+	else:
+		for name, url_list in url_info.items():
+			try:
+				await fetch_file(name, url_list)
+			except Exception as e:
+				exception = e
 
 	if exception is not None:
 		raise exception
@@ -254,6 +281,7 @@ async def do_fix(sess, bv, path, /, stall = None, ignore = None, max_duration =
 		info = None
 		exception = None
 		fetched_info = False
+		refresh = False
 
 		ignore = ignore or ""
 		stat = verify_bv(bv_root, ignore)
@@ -271,7 +299,7 @@ async def do_fix(sess, bv, path, /, stall = None, ignore = None, max_duration =
 
 		while not fetched_info:
 			if not info:
-				info = await fetch_info(sess, bv, stall)
+				info = await fetch_info(sess, bv, stall, refresh)
 				save_info(info, bv_root)
 				fetched_info = True
 
@@ -289,6 +317,8 @@ async def do_fix(sess, bv, path, /, stall = None, ignore = None, max_duration =
 					else:
 						logger.debug("dropping info and re-fetch")
 						info = None
+						# a cached response may carry the same stale cover
+						refresh = True
 			else:
 				break
 
@@ -340,7 +370,8 @@ async def do_fix(sess, bv, path, /, stall = None, ignore = None, max_duration =
 
 
 async def do_update(sess, bv, path, force, /, stall = None, ignore = None, max_duration = None, **kwargs):
-	info = await fetch_info(sess, bv, stall)
+	# updating means fetching the current info
+	info = await fetch_info(sess, bv, stall, refresh = True)
 
 	logger.info("downloading %s, title %s", bv, info.get("title", ""))
 	exception = None
@@ -417,21 +448,29 @@ async def download(sess, bv, video_root, mode, /, stall = None, **kwargs):
 		await do_update(sess, bv, video_root, mode == "force", stall, **kwargs)
 
 
-async def batch_download(sess, bv_list, video_root, mode, **kwargs):
-	logger.info("downloading %d videos", len(bv_list))
+async def batch_download(sess, bv_list, video_root, mode, *, jobs = 1, **kwargs):
+	logger.info("downloading %d videos, jobs %d", len(bv_list), jobs)
 	fetched_video = 0
-	stall = runtime.Stall()
-	for bv in bv_list:
-		fetch_status = False
-		try:
-			assert(core.bvid_pattern.fullmatch(bv))
-			await download(sess, bv, video_root, mode, stall, **kwargs)
-			fetched_video += 1
-			fetch_status = True
-		except Exception as e:
-			logger.exception("failed to fetch video %s", bv)
+	stall = runtime.Stall(controller = ratelimit.api_backoff)
+	# all workers share one iterator and one stall, API requests are still
+	# serialized by the stall while media transfers of different BV overlap
+	bv_iter = iter(bv_list)
+
+	async def worker():
+		nonlocal fetched_video
+		for bv in bv_iter:
+			fetch_status = False
+			try:
+				assert(core.bvid_pattern.fullmatch(bv))
+				await download(sess, bv, video_root, mode, stall, **kwargs)
+				fetched_video += 1
+				fetch_status = True
+			except Exception as e:
+				logger.exception("failed to fetch video %s", bv)
+
+			runtime.report("video", fetch_status, bv)
 
-		runtime.report("video", fetch_status, bv)
+	await asyncio.gather(*(worker() for i in range(max(jobs or 1, 1))))
 
 	logger.info("finish video download %d/%d", fetched_video, len(bv_list))
 
@@ -451,11 +490,11 @@ async def main(args):
 
 	video_root = args.dir or runtime.subdir("video")
 	async with network.session() as sess:
-		await batch_download(sess, bv_list, video_root, mode = args.mode, ignore = args.ignore, prefer = args.prefer, reject = args.reject)
+		await batch_download(sess, bv_list, video_root, mode = args.mode, jobs = args.jobs, parallel = args.parallel, ignore = args.ignore, prefer = args.prefer, reject = args.reject)
 
 
 if __name__ == "__main__":
-	args = runtime.parse_args(("network", "auth", "dir", "bandwidth", "video_mode", "video_ignore", "prefer"), [
+	args = runtime.parse_args(("network", "auth", "dir", "bandwidth", "jobs", "video_mode", "video_ignore", "prefer"), [
 		(("inputs",), {"nargs" : '*'}),
 	])
 	asyncio.run(main(args))
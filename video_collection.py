@@ -10,6 +10,8 @@ import network
 
 USER_VIDEO_LIST_URL = "https://api.bilibili.com/x/space/wbi/arc/search"
 USER_COLLECTIONS_URL = "https://api.bilibili.com/x/polymer/web-space/seasons_series_list"
+COLLECTION_CACHE_TTL = 600
+
 # USER_CHANNEL_LIST_URL = "https://api.bilibili.com/x/space/channel/video"
 
 USER_SERIES_LIST_URL = "https://api.bilibili.com/x/series/archives"
@@ -21,23 +23,23 @@ logger = logging.getLogger("bili_arch.collection")
 
 # helper functions
 
-async def get_video_page(sess, uid, page):
-	resp = await network.request(sess, "GET", USER_VIDEO_LIST_URL, wbi_sign = True, params = {"mid": uid, "pn": page})
+async def get_video_page(sess, uid, page, stall = None):
+	resp = await network.request(sess, "GET", USER_VIDEO_LIST_URL, wbi_sign = True, stall = stall, cache_ttl = COLLECTION_CACHE_TTL, params = {"mid": uid, "pn": page})
 	return resp.get("data")
 
 
-async def get_collections(sess, uid, page):
-	resp = await network.request(sess, "GET", USER_COLLECTIONS_URL, wbi_sign = True, params = {"mid": uid, "page_num": page, "page_size": 20})
+async def get_collections(sess, uid, page, stall = None):
+	resp = await network.request(sess, "GET", USER_COLLECTIONS_URL, wbi_sign = True, stall = stall, cache_ttl = COLLECTION_CACHE_TTL, params = {"mid": uid, "page_num": page, "page_size": 20})
 	return resp.get("data")
 
 
-async def get_series_page(sess, uid, sid, page):
-	resp = await network.request(sess, "GET", USER_SERIES_LIST_URL, wbi_sign = True, params = {"mid": uid, "series_id": sid, "pn": page})
+async def get_series_page(sess, uid, sid, page, stall = None):
+	resp = await network.request(sess, "GET", USER_SERIES_LIST_URL, wbi_sign = True, stall = stall, cache_ttl = COLLECTION_CACHE_TTL, params = {"mid": uid, "series_id": sid, "pn": page})
 	return resp.get("data")
 
 
-async def get_season_page(sess, uid, sid, page):
-	resp = await network.request(sess, "GET", USER_SEASON_LIST_URL, wbi_sign = True, params = {"mid": uid, "season_id": sid, "page_num": page})
+async def get_season_page(sess, uid, sid, page, stall = None):
+	resp = await network.request(sess, "GET", USER_SEASON_LIST_URL, wbi_sign = True, stall = stall, cache_ttl = COLLECTION_CACHE_TTL, params = {"mid": uid, "season_id": sid, "page_num": page})
 	return resp.get("data")
 
 
@@ -50,9 +52,8 @@ async def fetch_user_videos(sess, uid, stall = None):
 	page_index = 1
 	try:
 		while video_count is None or len(video_list) < video_count:
-			stall and await stall()
 			logger.debug("fetching page %d", page_index)
-			video_page = await get_video_page(sess, uid, page_index)
+			video_page = await get_video_page(sess, uid, page_index, stall)
 
 			if video_info is None:
 				video_info = video_page.get("list").get("tlist")
@@ -90,9 +91,8 @@ async def fetch_user_collection_videos(sess, meta, stall = None):
 	page_index = 1
 	try:
 		while len(video_list) < video_count:
-			stall and await stall()
 			logger.debug("fetching page %d", page_index)
-			video_page = await get_func(sess, uid, sid, page_index)
+			video_page = await get_func(sess, uid, sid, page_index, stall)
 			videos = video_page.get("archives")
 			if not videos:
 				logger.warning("empty video page %d, stop here", page_index)
@@ -109,8 +109,7 @@ async def fetch_user_collection_videos(sess, meta, stall = None):
 async def fetch_user_collection_list(sess, uid, stall = None):
 	try:
 		# TODO handle collection_list more than one page
-		stall and await stall()
-		collections = await get_collections(sess, uid, 1)
+		collections = await get_collections(sess, uid, 1, stall)
 		season_list = collections.get("items_lists").get("seasons_list")
 		series_list = collections.get("items_lists").get("series_list")
 
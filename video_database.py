@@ -7,13 +7,18 @@ sys.path[0] = os.getcwd()
 import re
 import time
 import json
+import base64
 import logging
 import sqlite3
 import argparse
 from stat import S_ISREG
+from itertools import repeat
+from functools import partial
 from contextlib import suppress
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 
+import core
 import constants
 
 # constants
@@ -37,14 +42,49 @@ def parse_cmp(value):
 		return (res.group(1) or "="), res.group(2)
 
 
+# opaque page cursor, position of the last row in (order_key, bvid) order
+def encode_cursor(order_key, order_dir, value, bvid):
+	data = json.dumps([order_key, order_dir, value, bvid], ensure_ascii = False, separators = (',', ':'))
+	return base64.urlsafe_b64encode(data.encode()).decode()
+
+def decode_cursor(cursor, order_key, order_dir):
+	data = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+	if not isinstance(data, list) or len(data) != 4 or data[0:2] != [order_key, order_dir]:
+		raise ValueError("cursor mismatch")
+	return data[2], data[3]
+
+
+# conditions for rows after the cursor, each one is a contiguous range of the index.
+# NULLs sort first ascending and last descending, they need a range of their own
+def make_keyset_cond(order_key, order_dir, value, bvid):
+	verb = (order_dir == "DESC") and "<" or ">"
+	if value is None:
+		cond_list = [("%s IS NULL AND bvid %s ?" % (order_key, verb), [bvid])]
+	else:
+		cond_list = [("(%s, bvid) %s (?, ?)" % (order_key, verb), [value, bvid])]
+
+	if order_key in nullable_keys and (value is None) == (order_dir == "ASC"):
+		cond_list.append(("%s IS %sNULL" % (order_key, (value is None) and "NOT " or ""), []))
+	return cond_list
+
+
+# FTS5 phrase, trigram tokenizer matches it as a substring
+def make_fts_phrase(value):
+	return '"%s"' % value.replace('"', '""')
+
+
 ## table definition
 ## Dict are ordered on Python 3.6+
 
+# bump on schema changes, upgrade_tables brings older databases up to date
+SCHEMA_VERSION = 1
+
 meta_table_name = "meta_table"
 
 meta_table_desc = {
 	"root":		"TEXT NOT NULL",
 	"ctime":	"INTEGER NOT NULL",
+	"version":	"INTEGER NOT NULL DEFAULT 0",
 }
 
 video_table_name = "video_table"
@@ -94,20 +134,66 @@ author_table_desc = {
 	"role":		"TEXT",
 }
 
+# stat of video directory and info.json when the video was last stored,
+# info.json is replaced by rename so changes show up in directory mtime
+journal_table_name = "journal_table"
+
+journal_table_desc = {
+	"bvid":			"TEXT PRIMARY KEY REFERENCES %s (bvid)" % video_table_name,
+	"dir_mtime":	"INTEGER NOT NULL",
+	"dir_inode":	"INTEGER NOT NULL",
+	"info_mtime":	"INTEGER NOT NULL",
+	"info_inode":	"INTEGER NOT NULL",
+}
+
 view_table_name = "search_view"
 
+# one row per video with its first author, no GROUP BY so the view can be
+# flattened and COUNT / ORDER BY ... LIMIT use the indexes on video_table
 view_table_def = """\
 SELECT v.bvid, v.mtime, v.title, v.tags, v.parts, v.cover, v.duration, \
 v.ctime, v.pubtime, v.views, v.likes, v.size, v.flags, u.uid, u.uname, a.role \
-FROM %s v JOIN %s a ON v.bvid == a.bvid JOIN %s u ON u.uid == a.uid \
-""" % (video_table_name, author_table_name, user_table_name)
+FROM {0} v LEFT JOIN {1} a ON a.bvid == v.bvid \
+AND a.uid == (SELECT uid FROM {1} WHERE bvid == v.bvid ORDER BY uid LIMIT 1) \
+LEFT JOIN {2} u ON u.uid == a.uid \
+""".format(video_table_name, author_table_name, user_table_name)
+
+# filters on authors match any author of the video
+author_cond_def = "bvid IN (SELECT a.bvid FROM %s a JOIN %s u ON u.uid == a.uid WHERE u.%%s %%s ?)" % (author_table_name, user_table_name)
+
+
+## full-text search, rowid derived from bvid/uid for replacing rows
+
+video_search_table_name = "video_search_table"
+
+video_search_table_def = "bvid UNINDEXED, title, tags, desc, tokenize = 'trigram'"
+
+user_search_table_name = "user_search_table"
+
+user_search_table_def = "uid UNINDEXED, uname, tokenize = 'trigram'"
+
+# trigram tokenizer cannot match shorter strings
+FTS_MIN_LENGTH = 3
 
 
 db_tables = {
 	video_table_name:	make_sql_column_def(video_table_desc),
 	part_table_name:	make_sql_column_def(part_table_desc),
 	user_table_name:	make_sql_column_def(user_table_desc),
-	author_table_name:	make_sql_column_def(author_table_desc, "PRIMARY KEY (uid, bvid)")
+	author_table_name:	make_sql_column_def(author_table_desc, "PRIMARY KEY (uid, bvid)"),
+	journal_table_name:	make_sql_column_def(journal_table_desc),
+}
+
+db_indexes = {
+	"part_bvid_index":		"%s (bvid)" % part_table_name,
+	"author_bvid_index":	"%s (bvid, uid)" % author_table_name,
+	"video_mtime_index":	"%s (mtime)" % video_table_name,
+	"video_pubtime_index":	"%s (pubtime)" % video_table_name,
+	"video_ctime_index":	"%s (ctime)" % video_table_name,
+	"video_duration_index":	"%s (duration)" % video_table_name,
+	"video_views_index":	"%s (views)" % video_table_name,
+	"video_likes_index":	"%s (likes)" % video_table_name,
+	"video_size_index":		"%s (size)" % video_table_name,
 }
 
 query_keys = {
@@ -127,7 +213,23 @@ query_keys = {
 	"size": (parse_cmp, " AND "),
 }
 
-order_keys = ("mtime", "title", "tags", "parts", "duration", "ctime", "pubtime", "views", "uname", "uid")
+search_keys = {
+	"title": video_search_table_name,
+	"tags": video_search_table_name,
+	"desc": video_search_table_name,
+	"uname": user_search_table_name,
+}
+
+order_keys = ("mtime", "title", "tags", "parts", "duration", "ctime", "pubtime", "views", "uname", "uid", "rank")
+
+# order keys that can be NULL, uname and uid come from LEFT JOIN in the view
+nullable_keys = tuple(k for k in order_keys if k in ("uname", "uid") or "NOT NULL" not in video_table_desc.get(k, "NOT NULL"))
+
+COUNT_CACHE_SIZE = 0x40
+
+# videos per transaction and per task of worker processes in walk
+WALK_BATCH_SIZE = 0x200
+WALK_CHUNK_SIZE = 0x10
 
 # static objects
 
@@ -136,6 +238,8 @@ logger = logging.getLogger("bili_arch.video_database")
 order_pattern = re.compile(r"([+-]?)(\w+)")
 cid_pattern = re.compile(r"(\d+)")
 
+BVID_ALPHABET = "123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz"
+
 def empty_func(*args):
 	pass
 
@@ -160,6 +264,106 @@ def set_persist_wal(database):
 	pass
 
 
+# bijective map from bvid to integer, used as rowid in search table
+def bvid_key(bvid):
+	key = 0
+	for c in bvid[3:]:
+		key = key * len(BVID_ALPHABET) + BVID_ALPHABET.index(c)
+	return key
+
+
+def read_info_json(bv_root):
+	mtime = None
+	bv_info = {}
+	authors = {}
+	parts = {}
+
+	with open(os.path.join(bv_root, "info.json"), 'r') as f:
+		raw_info = json.load(f)
+		stat = os.fstat(f.fileno())
+		mtime = int(stat.st_mtime)
+
+	for k in ("bvid", "title", "desc", "duration", "ctime"):
+		bv_info[k] = raw_info[k]
+
+	bv_info["mtime"] = mtime
+	bv_info["pubtime"] = raw_info["pubdate"]
+	bv_info["parts"] = raw_info["videos"]
+	bv_info["tags"] = raw_info["tname"]
+	bv_info["cover"] = os.path.split(raw_info["pic"])[1]
+	bv_info["views"] = raw_info["stat"]["view"]
+	bv_info["likes"] = raw_info["stat"]["like"]
+	bv_info["size"] = None
+	bv_info["flags"] = None
+
+	raw_authors = raw_info.get("staff")
+	if raw_authors:
+		for usr in raw_authors:
+			uid_num = int(usr["mid"])
+			authors[uid_num] = {
+				"uid": usr["mid"],
+				"mtime": mtime,
+				"bvid": raw_info["bvid"],
+				"uname": usr["name"],
+				"role": usr["title"],
+				"face": os.path.split(usr["face"])[1],
+			}
+	else:
+		owner = raw_info["owner"]
+		uid_num = int(owner["mid"])
+		authors[uid_num] = {
+			"uid": owner["mid"],
+			"mtime": mtime,
+			"bvid": raw_info["bvid"],
+			"uname": owner["name"],
+			"role": None,
+			"face": os.path.split(owner["face"])[1],
+		 }
+
+	for part in raw_info["pages"]:
+		cid_num = int(part["cid"])
+		parts[cid_num] = {
+			"cid": part["cid"],
+			"bvid": raw_info["bvid"],
+			"part": part["page"],
+			"title": part["part"],
+			"duration": part["duration"],
+			"size": None
+		}
+
+	return {
+		"bv_info": bv_info,
+		"authors": authors,
+		"parts": parts,
+	}
+
+
+def make_journal(bvid, dir_stat, info_stat):
+	return {
+		"bvid": bvid,
+		"dir_mtime": dir_stat.st_mtime_ns,
+		"dir_inode": dir_stat.st_ino,
+		"info_mtime": info_stat.st_mtime_ns,
+		"info_inode": info_stat.st_ino,
+	}
+
+
+# parse info.json and part sizes of one video, runs in worker processes of walk
+def scan_video(video_root, bvid):
+	try:
+		bv_root = os.path.join(video_root, bvid)
+		info = read_info_json(bv_root)
+		snapshot = core.dir_snapshot(bv_root)
+		for cid, part_snapshot in snapshot.dirs.items():
+			part = cid_pattern.fullmatch(cid) and info["parts"].get(int(cid))
+			if part:
+				part["size"] = part_snapshot.size()
+		return bvid, info
+	except Exception:
+		logger.exception("failed to walk %s", bvid)
+		return bvid, None
+
+
 # classes
 
 class VideoDatabase:
@@ -178,6 +382,9 @@ class VideoDatabase:
 		# assert(sqlite3.threadsafety == 3)
 		self.database = self.connect(db_file)
 		self.database.row_factory = VideoDatabase.dict_factory
+		self.has_search = self.check_search_tables()
+		self.count_cache = OrderedDict()
+		self.data_version = None
 
 
 	def __del__(self):
@@ -197,13 +404,26 @@ class VideoDatabase:
 				self.database = None
 
 
+	def check_search_tables(self):
+		cursor = self.database.cursor()
+		try:
+			cursor.execute("SELECT COUNT(*) as count FROM sqlite_schema WHERE name IN (?, ?)", (video_search_table_name, user_search_table_name))
+			return cursor.fetchone()["count"] == 2
+		finally:
+			cursor.close()
+
+
 	def query(self, rules = {}):
 		cond_list = []
 		arg_list = []
+		match_list = []
 		order_key = "mtime"
 		order_dir = "DESC"
 		offset = 0
 		limit = None
+		after = None
+		with_count = True
+		filter_list = []
 
 		for k, v in rules.items():
 			if k == "order":
@@ -224,11 +444,29 @@ class VideoDatabase:
 			elif k == "limit":
 				limit = int(v[0])
 				continue
+			elif k == "after":
+				after = v[0]
+				continue
+			elif k == "count":
+				with_count = (v[0] not in ("0", "false"))
+				continue
 
 			query_obj = query_keys.get(k)
 			if not query_obj:
 				raise KeyError("invalid key %s" % k)
 
+			filter_list.append((k, tuple(v)))
+			search_table = search_keys.get(k)
+			if search_table and self.has_search and all(len(value) >= FTS_MIN_LENGTH for value in v):
+				match_expr = " OR ".join(make_fts_phrase(value) for value in v)
+				if search_table == video_search_table_name:
+					cond_list.append("( bvid IN (SELECT bvid FROM %s WHERE %s MATCH ?) )" % (search_table, k))
+					match_list.append("%s : (%s)" % (k, match_expr))
+				else:
+					cond_list.append("( bvid IN (SELECT bvid FROM %s WHERE uid IN (SELECT CAST(uid AS TEXT) FROM %s WHERE %s MATCH ?)) )" % (author_table_name, search_table, k))
+				arg_list.append(match_expr)
+				continue
+
 			sub_cond = []
 			for value in v:
 				if callable(query_obj[0]):
@@ -236,7 +474,13 @@ class VideoDatabase:
 				else:
 					verb = query_obj[0]
 
-				sub_cond.append("%s %s ?" % (k, verb))
+				if k == "desc":
+					# not in the view
+					sub_cond.append("bvid IN (SELECT bvid FROM %s WHERE desc %s ?)" % (video_table_name, verb))
+				elif k in ("uid", "uname"):
+					sub_cond.append(author_cond_def % (k, verb))
+				else:
+					sub_cond.append("%s %s ?" % (k, verb))
 
 				if verb == "LIKE":
 					value = "%%%s%%" % value
@@ -244,11 +488,33 @@ class VideoDatabase:
 
 			cond_list.append("( %s )" % query_obj[1].join(sub_cond))
 
-		sql = "SELECT * FROM " + view_table_name
+		if order_key == "rank" and not match_list:
+			order_key = "mtime"
+			order_dir = "DESC"
+
+		where = ""
 		if cond_list:
-			sql += " WHERE " + " AND ".join(cond_list)
+			where = " WHERE " + " AND ".join(cond_list)
+
+		# all conditions are on video_table columns or bvid, count without joining authors
+		count_sql = "SELECT COUNT(*) as count FROM %s%s" % (video_table_name, where)
+		count_args = list(arg_list)
+		count_key = tuple(sorted(filter_list))
+
+		# keyset pagination, offset is ignored when continuing from a cursor
+		page_list = [("", [])]
+		if after:
+			value, bvid = decode_cursor(after, order_key, order_dir)
+			page_list = make_keyset_cond(order_key, order_dir, value, bvid)
+			offset = 0
+
+		sql = "SELECT * FROM " + view_table_name
+		if order_key == "rank":
+			# relevance of all text filters, bm25 based and smaller is better
+			sql = "SELECT * FROM (SELECT s.*, r.rank AS rank FROM %s s JOIN (SELECT bvid, rank FROM %s WHERE %s MATCH ?) r ON s.bvid == r.bvid)" % (view_table_name, video_search_table_name, video_search_table_name)
+			arg_list.insert(0, " AND ".join(match_list))
 
-		sql += " GROUP BY bvid"
+		sql += where
 
 		logger.debug(sql)
 		logger.debug(arg_list)
@@ -257,22 +523,56 @@ class VideoDatabase:
 		try:
 			cursor.arraysize = 0x40
 			cursor.execute("BEGIN")
-			cursor.execute("SELECT COUNT(*) as count FROM ( %s )" % sql, arg_list)
-			count = cursor.fetchone()["count"]
-
-			sql += " ORDER BY %s %s" % (order_key, order_dir)
-			if limit or offset:
-				sql += " LIMIT %d OFFSET %d" % (limit or -1, offset)
-
-			logger.debug(sql)
-			cursor.execute(sql, arg_list)
-			data = cursor.fetchall()
+			count = None
+			if with_count:
+				count = self.get_count(cursor, count_key, count_sql, count_args)
+
+			data = []
+			for page_cond, page_args in page_list:
+				page_sql = sql
+				if page_cond:
+					page_sql += (where and " AND " or " WHERE ") + page_cond
+				page_sql += " ORDER BY {0} {1}, bvid {1}".format(order_key, order_dir)
+				if limit or offset:
+					page_sql += " LIMIT %d OFFSET %d" % (limit and (limit - len(data)) or -1, offset)
+
+				logger.debug(page_sql)
+				cursor.execute(page_sql, arg_list + page_args)
+				data += cursor.fetchall()
+				if limit and len(data) >= limit:
+					break
 			cursor.execute("END")
-			return data, count
+
+			next_cursor = None
+			if data and limit and len(data) >= limit:
+				next_cursor = encode_cursor(order_key, order_dir, data[-1][order_key], data[-1]["bvid"])
+			return data, count, next_cursor
 		finally:
 			cursor.close()
 
 
+	# total count of a filter is cached until the database is changed
+	def get_count(self, cursor, count_key, count_sql, count_args):
+		# data_version only tracks commits from other connections
+		cursor.execute("PRAGMA data_version")
+		data_version = (cursor.fetchone()["data_version"], self.database.total_changes)
+		if data_version != self.data_version:
+			self.count_cache.clear()
+			self.data_version = data_version
+
+		count = self.count_cache.get(count_key)
+		if count is None:
+			cursor.execute(count_sql, count_args)
+			count = cursor.fetchone()["count"]
+			self.count_cache[count_key] = count
+			if len(self.count_cache) > COUNT_CACHE_SIZE:
+				self.count_cache.popitem(last = False)
+		else:
+			self.count_cache.move_to_end(count_key)
+
+		return count
+
+
 	def load_info_db(self, cursor, bvid):
 		cursor.execute("SELECT * FROM %s WHERE bvid = ?" % video_table_name, (bvid, ))
 		bv_info = cursor.fetchone()
@@ -315,6 +615,7 @@ class VideoDatabaseManager(VideoDatabase):
 		super().__init__(db_file)
 		self.video_root = os.path.realpath(video_root)
 		set_persist_wal(self.database)
+		self.database.create_function("bvid_key", 1, bvid_key, deterministic = True)
 
 		cursor = self.database.cursor()
 		try:
@@ -323,6 +624,7 @@ class VideoDatabaseManager(VideoDatabase):
 			self.init_tables(cursor, update_path)
 		finally:
 			cursor.close()
+		self.has_search = self.check_search_tables()
 
 
 	def init_tables(self, cursor, /, update_path = False):
@@ -331,7 +633,7 @@ class VideoDatabaseManager(VideoDatabase):
 			cursor.execute("SELECT COUNT(*) as count FROM sqlite_schema WHERE name == '%s' AND type == 'table' " % meta_table_name)
 			if cursor.fetchone()["count"] == 0:
 				cursor.execute("CREATE TABLE %s (%s)" % (meta_table_name, make_sql_column_def(meta_table_desc)))
-				cursor.execute("INSERT INTO %s (root, ctime) VALUES (?, ?)" % meta_table_name, (self.video_root, int(time.time())))
+				cursor.execute("INSERT INTO %s (root, ctime, version) VALUES (?, ?, ?)" % meta_table_name, (self.video_root, int(time.time()), SCHEMA_VERSION))
 				cursor.execute("COMMIT")
 				cursor.execute("BEGIN IMMEDIATE")
 			else:
@@ -348,7 +650,11 @@ class VideoDatabaseManager(VideoDatabase):
 
 			for table, desc in reversed(db_tables.items()):
 				cursor.execute("CREATE TABLE IF NOT EXISTS %s (%s) WITHOUT ROWID" % (table, desc))
+			self.upgrade_tables(cursor)
+			for index, desc in db_indexes.items():
+				cursor.execute("CREATE INDEX IF NOT EXISTS %s ON %s" % (index, desc))
 			cursor.execute("CREATE VIEW IF NOT EXISTS %s AS %s" % (view_table_name, view_table_def))
+			self.init_search_tables(cursor)
 			cursor.execute("COMMIT")
 		except Exception:
 			logger.error("exception in creating tables")
@@ -356,77 +662,62 @@ class VideoDatabaseManager(VideoDatabase):
 			raise
 
 
-	def load_info_json(self, bvid):
-		mtime = None
-		bv_info = {}
-		authors = {}
-		parts = {}
+	def upgrade_tables(self, cursor):
+		cursor.execute("SELECT name FROM pragma_table_info('%s')" % meta_table_name)
+		if "version" not in (row["name"] for row in cursor.fetchall()):
+			cursor.execute("ALTER TABLE %s ADD COLUMN version %s" % (meta_table_name, meta_table_desc["version"]))
 
-		bv_root = os.path.join(self.video_root, bvid)
-		with open(os.path.join(bv_root, "info.json"), 'r') as f:
-			raw_info = json.load(f)
-			stat = os.fstat(f.fileno())
-			mtime = int(stat.st_mtime)
-
-		for k in ("bvid", "title", "desc", "duration", "ctime"):
-			bv_info[k] = raw_info[k]
-
-		bv_info["mtime"] = mtime
-		bv_info["pubtime"] = raw_info["pubdate"]
-		bv_info["parts"] = raw_info["videos"]
-		bv_info["tags"] = raw_info["tname"]
-		bv_info["cover"] = os.path.split(raw_info["pic"])[1]
-		bv_info["views"] = raw_info["stat"]["view"]
-		bv_info["likes"] = raw_info["stat"]["like"]
-		bv_info["size"] = None
-		bv_info["flags"] = None
-
-		raw_authors = raw_info.get("staff")
-		if raw_authors:
-			for usr in raw_authors:
-				uid_num = int(usr["mid"])
-				authors[uid_num] = {
-					"uid": usr["mid"],
-					"mtime": mtime,
-					"bvid": raw_info["bvid"],
-					"uname": usr["name"],
-					"role": usr["title"],
-					"face": os.path.split(usr["face"])[1],
-				}
-		else:
-			owner = raw_info["owner"]
-			uid_num = int(owner["mid"])
-			authors[uid_num] = {
-				"uid": owner["mid"],
-				"mtime": mtime,
-				"bvid": raw_info["bvid"],
-				"uname": owner["name"],
-				"role": None,
-				"face": os.path.split(owner["face"])[1],
-			 }
-
-		for part in raw_info["pages"]:
-			cid_num = int(part["cid"])
-			parts[cid_num] = {
-				"cid": part["cid"],
-				"bvid": raw_info["bvid"],
-				"part": part["page"],
-				"title": part["part"],
-				"duration": part["duration"],
-				"size": None
-			}
+		cursor.execute("SELECT version FROM %s" % meta_table_name)
+		version = cursor.fetchone()["version"]
+		if version >= SCHEMA_VERSION:
+			return
 
-		return {
-			"bv_info": bv_info,
-			"authors": authors,
-			"parts": parts,
-		}
+		logger.info("upgrading database schema %d to %d", version, SCHEMA_VERSION)
+		if version < 1:
+			# indexes are created by init_tables, rebuild the view without GROUP BY
+			cursor.execute("DROP VIEW IF EXISTS %s" % view_table_name)
+
+		cursor.execute("UPDATE %s SET version = ?" % meta_table_name, (SCHEMA_VERSION, ))
+		cursor.execute("ANALYZE")
+
+
+	# FTS5 with trigram tokenizer needs SQLite 3.34+, fallback to LIKE if not available
+	def init_search_tables(self, cursor):
+		cursor.execute("SAVEPOINT search_tables")
+		try:
+			cursor.execute("SELECT COUNT(*) as count FROM sqlite_schema WHERE name == ?", (video_search_table_name, ))
+			if cursor.fetchone()["count"] == 0:
+				logger.info("creating search tables")
+				cursor.execute("CREATE VIRTUAL TABLE %s USING fts5(%s)" % (video_search_table_name, video_search_table_def))
+				cursor.execute("INSERT INTO %s (rowid, bvid, title, tags, desc) SELECT bvid_key(bvid), bvid, title, tags, desc FROM %s" % (video_search_table_name, video_table_name))
+
+			cursor.execute("SELECT COUNT(*) as count FROM sqlite_schema WHERE name == ?", (user_search_table_name, ))
+			if cursor.fetchone()["count"] == 0:
+				cursor.execute("CREATE VIRTUAL TABLE %s USING fts5(%s)" % (user_search_table_name, user_search_table_def))
+				cursor.execute("INSERT INTO %s (rowid, uid, uname) SELECT CAST(uid AS INTEGER), uid, uname FROM %s" % (user_search_table_name, user_table_name))
+
+			cursor.execute("RELEASE search_tables")
+		except sqlite3.OperationalError as e:
+			logger.warning("full-text search not available: %s", str(e))
+			cursor.execute("ROLLBACK TO search_tables")
+			cursor.execute("RELEASE search_tables")
+
+
+	def load_info_json(self, bvid):
+		return read_info_json(os.path.join(self.video_root, bvid))
 
 	def store_bv_info(self, cursor, bv_info):
-		cursor.execute("INSERT OR REPLACE INTO %s VALUES (%s)" % (video_table_name, make_sql_placeholder(video_table_desc)), bv_info)
+		self.store_bv_list(cursor, (bv_info, ))
 
+	def store_bv_list(self, cursor, bv_list):
+		cursor.executemany("INSERT OR REPLACE INTO %s VALUES (%s)" % (video_table_name, make_sql_placeholder(video_table_desc)), bv_list)
+		if self.has_search:
+			cursor.executemany("INSERT OR REPLACE INTO %s (rowid, bvid, title, tags, desc) VALUES (bvid_key(:bvid), :bvid, :title, :tags, :desc)" % video_search_table_name, bv_list)
+
+	# keep the known size of parts without one
 	def store_parts(self, cursor, part_list):
-		cursor.executemany("INSERT OR REPLACE INTO %s VALUES (%s)" % (part_table_name, make_sql_placeholder(part_table_desc)), part_list)
+		update_list = ", ".join("{0} = excluded.{0}".format(k) for k in part_table_desc.keys() if k not in ("cid", "size"))
+		cursor.executemany("INSERT INTO %s VALUES (%s) ON CONFLICT (cid) DO UPDATE SET %s, size = COALESCE(excluded.size, size)" % (part_table_name, make_sql_placeholder(part_table_desc), update_list), part_list)
 
 	def store_authors(self, cursor, author_list):
 		for author in author_list:
@@ -434,14 +725,21 @@ class VideoDatabaseManager(VideoDatabase):
 			if cursor.fetchone()["count"] == 0:
 				author = defaultdict(empty_func, author)
 				cursor.execute("INSERT OR REPLACE INTO %s VALUES (%s)" % (user_table_name, make_sql_placeholder(user_table_desc)), author)
+				if self.has_search:
+					cursor.execute("INSERT OR REPLACE INTO %s (rowid, uid, uname) VALUES (CAST(:uid AS INTEGER), CAST(:uid AS TEXT), :uname)" % user_search_table_name, author)
 
 		cursor.executemany("INSERT INTO %s AS a VALUES (%s) ON CONFLICT DO UPDATE SET role = excluded.role WHERE excluded.role != a.role" % (author_table_name, make_sql_placeholder(author_table_desc)), author_list)
 
+	def store_journal(self, cursor, journal_list):
+		cursor.executemany("INSERT OR REPLACE INTO %s VALUES (%s)" % (journal_table_name, make_sql_placeholder(journal_table_desc)), journal_list)
+
 	def update_video(self, bvid):
 		if not constants.bvid_pattern.fullmatch(bvid):
 			raise ValueError("invalid video %s", bvid)
 
 		logger.debug("update video %s", bvid)
+		bv_root = os.path.join(self.video_root, bvid)
+		journal = make_journal(bvid, os.stat(bv_root), os.stat(os.path.join(bv_root, "info.json")))
 		json_info = self.load_info_json(bvid)
 
 		cursor = self.database.cursor()
@@ -453,6 +751,7 @@ class VideoDatabaseManager(VideoDatabase):
 				self.store_bv_info(cursor, json_info["bv_info"])
 				self.store_parts(cursor, json_info["parts"].values())
 				self.store_authors(cursor, json_info["authors"].values())
+				self.store_journal(cursor, (journal, ))
 
 				cursor.execute("COMMIT")
 				return True
@@ -488,6 +787,7 @@ class VideoDatabaseManager(VideoDatabase):
 				self.store_parts(cursor, part_list)
 
 			self.store_authors(cursor, json_info["authors"].values())
+			self.store_journal(cursor, (journal, ))
 			cursor.execute("COMMIT")
 			return True
 		except Exception:
@@ -497,6 +797,50 @@ class VideoDatabaseManager(VideoDatabase):
 		finally:
 			cursor.close()
 
+	# update_video and update_video_size of many videos in one transaction,
+	# returns bvid of updated videos
+	def update_videos(self, bvid_list):
+		info_list = []
+		for bvid in bvid_list:
+			if not constants.bvid_pattern.fullmatch(bvid):
+				logger.error("invalid video %s", bvid)
+				continue
+			try:
+				bv_root = os.path.join(self.video_root, bvid)
+				journal = make_journal(bvid, os.stat(bv_root), os.stat(os.path.join(bv_root, "info.json")))
+			except OSError as e:
+				logger.error("cannot stat %s: %s", bvid, str(e))
+				continue
+			bvid, info = scan_video(self.video_root, bvid)
+			if info:
+				info["journal"] = journal
+				info_list.append(info)
+
+		if not info_list:
+			return []
+
+		cursor = self.database.cursor()
+		try:
+			cursor.execute("SELECT bvid, mtime, flags FROM %s WHERE bvid IN (%s)" % (video_table_name, ", ".join("?" * len(info_list))), [info["bv_info"]["bvid"] for info in info_list])
+			db_videos = {row["bvid"]: row for row in cursor.fetchall()}
+		finally:
+			cursor.close()
+
+		update_list = []
+		for info in info_list:
+			bv_info = info["bv_info"]
+			row = db_videos.get(bv_info["bvid"])
+			if row:
+				if bv_info["mtime"] <= row["mtime"]:
+					logger.debug("skip video %s", bv_info["bvid"])
+					continue
+				bv_info["flags"] = row["flags"]
+			update_list.append(info)
+
+		if not update_list:
+			return []
+		return [info["bv_info"]["bvid"] for info in self.store_walk_batch(update_list, None)]
+
 	def store_sizes(self, cursor, bvid, size_list):
 		cursor.executemany("UPDATE OR IGNORE %s SET size = :size WHERE cid == :cid AND (size IS NULL OR size != :size)" % part_table_name, size_list)
 		if cursor.rowcount > 0:
@@ -505,6 +849,25 @@ class VideoDatabaseManager(VideoDatabase):
 		else:
 			return False
 
+	# sizes of single parts, [{"bvid": bvid, "cid": cid, "size": size}, ...]
+	def update_part_sizes(self, size_list):
+		bv_map = defaultdict(list)
+		for item in size_list:
+			bv_map[item["bvid"]].append(item)
+
+		cursor = self.database.cursor()
+		try:
+			cursor.execute("BEGIN IMMEDIATE")
+			for bvid, sizes in bv_map.items():
+				self.store_sizes(cursor, bvid, sizes)
+			cursor.execute("COMMIT")
+		except Exception:
+			logger.error("exception in updating part sizes")
+			cursor.execute("ROLLBACK")
+			raise
+		finally:
+			cursor.close()
+
 	def update_video_size(self, bvid):
 		if not constants.bvid_pattern.fullmatch(bvid):
 			raise ValueError("invalid video %s", bvid)
@@ -515,24 +878,13 @@ class VideoDatabaseManager(VideoDatabase):
 			sizes = []
 
 			logger.debug("checking video size %s", bvid)
+			snapshot = core.dir_snapshot(bv_root)
 			cursor.execute("BEGIN DEFERRED")
-			with os.scandir(bv_root) as it:
-				for bv_entry in it:
-					if bv_entry.is_dir() and cid_pattern.fullmatch(bv_entry.name):
-						cid = bv_entry.name
-						logger.debug("walking cid %s", cid)
-
-						part_path = os.path.join(bv_root, cid)
-						part_size = 0
-						with os.scandir(part_path) as part_it:
-							for part_entry in part_it:
-								if part_entry.is_file(follow_symlinks = False):
-									stat = part_entry.stat(follow_symlinks = False)
-									logger.debug("file %s: %d", part_entry.name, stat.st_size)
-									part_size += stat.st_size
-								else:
-									logger.debug("skip %s", part_entry.name)
-						sizes.append({ "cid": cid, "size": part_size })
+			for cid, part_snapshot in snapshot.dirs.items():
+				if cid_pattern.fullmatch(cid):
+					part_size = part_snapshot.size()
+					logger.debug("cid %s: %d", cid, part_size)
+					sizes.append({ "cid": cid, "size": part_size })
 
 			result = self.store_sizes(cursor, bvid, sizes)
 			cursor.execute("COMMIT")
@@ -563,8 +915,7 @@ class VideoDatabaseManager(VideoDatabase):
 		cursor = self.database.cursor()
 		try:
 			cursor.execute("BEGIN IMMEDIATE")
-			for table_name in (author_table_name, part_table_name, video_table_name):
-				cursor.execute("DELETE FROM %s WHERE bvid == ?" % table_name, (bvid, ))
+			self.delete_videos(cursor, (bvid, ))
 			cursor.execute("COMMIT")
 			return True
 		except Exception:
@@ -575,31 +926,157 @@ class VideoDatabaseManager(VideoDatabase):
 			cursor.close()
 
 
+	def delete_videos(self, cursor, bvid_list):
+		for table_name in (journal_table_name, author_table_name, part_table_name, video_table_name):
+			cursor.executemany("DELETE FROM %s WHERE bvid == ?" % table_name, ((bvid, ) for bvid in bvid_list))
+		if self.has_search:
+			cursor.executemany("DELETE FROM %s WHERE rowid == ?" % video_search_table_name, ((bvid_key(bvid), ) for bvid in bvid_list))
+
+
 	def add_user(self, user_info):
 		raise NotImplementedError()
 
 
-	def walk(self, *, callback = None):
+	# store results of scan_video in one transaction
+	def store_videos(self, info_list):
+		cursor = self.database.cursor()
+		try:
+			cursor.execute("BEGIN IMMEDIATE")
+			self.store_bv_list(cursor, [info["bv_info"] for info in info_list])
+			self.store_parts(cursor, [part for info in info_list for part in info["parts"].values()])
+			self.store_authors(cursor, [author for info in info_list for author in info["authors"].values()])
+			cursor.executemany("UPDATE OR IGNORE %s SET size = ( SELECT SUM(size) FROM %s where bvid == ?1 ) WHERE bvid == ?1" % (video_table_name, part_table_name), ((info["bv_info"]["bvid"], ) for info in info_list))
+			self.store_journal(cursor, [info["journal"] for info in info_list])
+			cursor.execute("COMMIT")
+		except Exception:
+			cursor.execute("ROLLBACK")
+			raise
+		finally:
+			cursor.close()
+
+
+	def store_walk_batch(self, info_list, callback):
+		try:
+			self.store_videos(info_list)
+		except Exception:
+			logger.exception("failed to store %d videos, retry one by one", len(info_list))
+			stored_list = []
+			for info in info_list:
+				try:
+					self.store_videos((info, ))
+					stored_list.append(info)
+				except Exception:
+					logger.exception("failed to store %s", info["bv_info"]["bvid"])
+			info_list = stored_list
+
+		if callable(callback):
+			for info in info_list:
+				callback(info["bv_info"]["bvid"])
+		return info_list
+
+
+	# videos are compared with the journal by directory stat, info.json is only
+	# checked when the directory changed. Changed videos are parsed in worker
+	# processes and stored in batches, rows of videos without info.json are removed
+	def walk(self, *, callback = None, jobs = 1):
 		start_time = int(time.time())
 		logger.info("start walking %s %d", self.video_root, start_time)
+
+		cursor = self.database.cursor()
+		try:
+			cursor.arraysize = 0x400
+			cursor.execute("SELECT v.bvid, v.mtime, v.flags, j.dir_mtime, j.dir_inode, j.info_mtime, j.info_inode FROM %s v LEFT JOIN %s j ON j.bvid == v.bvid" % (video_table_name, journal_table_name))
+			db_videos = {row["bvid"]: row for row in cursor.fetchall()}
+		finally:
+			cursor.close()
+
+		update_list = []
+		flags_map = {}
+		journal_map = {}
+		restat_list = []
+		video_count = 0
 		with os.scandir(self.video_root) as it:
 			for entry in it:
-				updated = False
+				bvid = entry.name
+				if not constants.bvid_pattern.fullmatch(bvid):
+					continue
+				row = db_videos.get(bvid)
 				try:
-					if entry.is_dir() and constants.bvid_pattern.fullmatch(entry.name):
-						bvid = entry.name
-						logger.debug("loading %s", bvid)
-						if self.update_video(bvid):
-							self.update_video_size(bvid)
-							updated = True
+					dir_stat = entry.stat()
+					if row and (row["dir_mtime"], row["dir_inode"]) == (dir_stat.st_mtime_ns, dir_stat.st_ino):
+						video_count += 1
+						del db_videos[bvid]
+						continue
 
-				except Exception:
-					logger.exception("failed to walk %s", entry.name)
+					info_stat = os.stat(os.path.join(entry.path, "info.json"))
+					if not S_ISREG(info_stat.st_mode):
+						continue
+				except FileNotFoundError:
+					continue
+				except OSError as e:
+					# may be transient, keep the stored video
+					logger.warning("cannot stat %s: %s", bvid, str(e))
+					db_videos.pop(bvid, None)
+					continue
+
+				video_count += 1
+				journal = make_journal(bvid, dir_stat, info_stat)
+				if row:
+					del db_videos[bvid]
+					if row["info_mtime"] is None:
+						unchanged = (int(info_stat.st_mtime) <= row["mtime"])
+					else:
+						unchanged = ((row["info_mtime"], row["info_inode"]) == (info_stat.st_mtime_ns, info_stat.st_ino))
+					if unchanged:
+						restat_list.append(journal)
+						continue
+					flags_map[bvid] = row["flags"]
+				journal_map[bvid] = journal
+				update_list.append(bvid)
+
+		logger.info("%d videos, %d to update, %d to remove", video_count, len(update_list), len(db_videos))
 
-				if updated and callable(callback):
-					callback(entry.name)
+		executor = None
+		update_count = 0
+		try:
+			if jobs > 1 and len(update_list) > WALK_CHUNK_SIZE:
+				executor = ProcessPoolExecutor(jobs)
+				results = executor.map(scan_video, repeat(self.video_root), update_list, chunksize = WALK_CHUNK_SIZE)
+			else:
+				results = map(partial(scan_video, self.video_root), update_list)
+
+			info_list = []
+			for bvid, info in results:
+				if not info:
+					continue
+				info["bv_info"]["flags"] = flags_map.get(bvid)
+				# stat before parsing, a later change is picked up by next walk
+				info["journal"] = journal_map[bvid]
+				info_list.append(info)
+				if len(info_list) >= WALK_BATCH_SIZE:
+					update_count += len(self.store_walk_batch(info_list, callback))
+					info_list = []
+
+			if info_list:
+				update_count += len(self.store_walk_batch(info_list, callback))
+		finally:
+			if executor:
+				executor.shutdown()
+
+		if db_videos or restat_list:
+			cursor = self.database.cursor()
+			try:
+				cursor.execute("BEGIN IMMEDIATE")
+				self.store_journal(cursor, restat_list)
+				self.delete_videos(cursor, db_videos.keys())
+				cursor.execute("COMMIT")
+			except Exception:
+				logger.exception("failed to update journal of %d videos and remove %d videos", len(restat_list), len(db_videos))
+				cursor.execute("ROLLBACK")
+			finally:
+				cursor.close()
 
-		logger.info("walking %s took %d seconds", self.video_root, int(time.time()) - start_time)
+		logger.info("walking %s took %d seconds, updated %d videos", self.video_root, int(time.time()) - start_time, update_count)
 
 
 	def autoremove(self):
@@ -623,7 +1100,7 @@ class VideoDatabaseManager(VideoDatabase):
 
 def main(args):
 	database = VideoDatabaseManager(args.dir, args.database)
-	database.walk()
+	database.walk(jobs = args.jobs)
 
 
 if __name__ == "__main__":
@@ -631,6 +1108,7 @@ if __name__ == "__main__":
 
 	parser = argparse.ArgumentParser()
 	parser.add_argument("-d", "--dir", required = True)
+	parser.add_argument("-j", "--jobs", type = int, default = os.cpu_count())
 	parser.add_argument("database")
 
 	args = parser.parse_args()